@@ -187,8 +187,50 @@ AUTHENTICATION_BACKENDS = [
 
 CRONJOBS = [
     ("0 0 * * 0", "django.core.management.call_command", ["flushexpiredtokens"]),
+    ("*/15 * * * *", "mlm.tasks.compact_company_wallet"),
+    ("*/10 * * * *", "mlm.tasks.retry_commission_jobs"),
+    # the day's closing runs before the midnight reset, so its paid pairs count against that
+    # day's cap and its FlushedPairs carry that day's date; a closing still running at midnight
+    # holds its earners' row locks, so the reset waits for it instead of racing it
+    ("55 23 * * *", "mlm.tasks.run_binary_closing"),
+    ("0 0 * * *", "mlm.tasks.reset_daily_counters"),
+    ("30 1 * * *", "mlm.tasks.recompute_all_ranks"),
 ]
 
+# MLM: matching income is paid by the periodic binary closing; set True to
+# also run the per-purchase upline walk inside MemberPlan.mark_completed.
+MLM_INLINE_MATCHING = False
+
+# MLM: process purchase commissions on a Celery worker (mlm.tasks.process_commission_job)
+# instead of inside the request; needs a running worker and broker.
+MLM_ASYNC_COMMISSIONS = False
+
+# MLM: the retry sweep (mlm.tasks.retry_commission_jobs) re-runs FAILED commission jobs and
+# PENDING/PROCESSING ones untouched for MLM_COMMISSION_STALE_AFTER seconds, until a job has
+# used MLM_COMMISSION_MAX_ATTEMPTS attempts; after that it stays FAILED for an admin
+MLM_COMMISSION_MAX_ATTEMPTS = 5
+MLM_COMMISSION_STALE_AFTER = 900
+
+# MLM: number of top active earners sharing the global pool (mlm.tasks.distribute_global_pool)
+MLM_GLOBAL_POOL_SIZE = 10
+
+# MLM: seconds a member's referral-generation report stays cached
+MLM_REFERRAL_REPORT_TTL = 300
+
+# MLM: seconds a plan's level table stays cached; the save/delete invalidation only reaches
+# the other gunicorn/celery/cron processes through a shared cache, this bounds staleness otherwise
+MLM_LEVEL_CACHE_TTL = 60
+
+# Shared cache for every process (gunicorn workers, celery, cron) when REDIS_URL is set,
+# e.g. REDIS_URL=redis://127.0.0.1:6379/1; per-process memory cache otherwise (dev/tests)
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
+
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "smtp.gmail.com"
@@ -22,6 +22,7 @@ urlpatterns = [
     path('courses/admin/', include('courses.admin_urls')),
     path('courses/', include('courses.public_urls')),
     path('projects/', include('projects.urls')), 
+    path('mlm/', include('mlm.urls')),
     path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='django.contrib.sitemaps.views.sitemap'),
 ]
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,18 +1,36 @@
 # mlm/admin.py
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import ValidationError
+from django.template.response import TemplateResponse
 from .models import (
-    CompanyWallet, Plan, Level, RankAndRewards, Member, MemberBankDetails,
-    MemberPlan, IncomeHistory, WalletTransaction, PaymentRequest
+    CompanyWallet, CompanyWalletShard, Plan, Level, RankAndRewards, Member, MemberBankDetails,
+    MemberPlan, IncomeHistory, IncomeDailyRollup, WalletTransaction, PaymentRequest, BinaryClosing,
+    CommissionJob, FlushedPairs
 )
+from .services import process_commissions_for_plans, relocate_subtree, run_commission_job
+
+class CompanyWalletShardInline(admin.TabularInline):
+    model = CompanyWalletShard
+    extra = 0
+    readonly_fields = ['shard_no', 'balance']
+    can_delete = False
+
 
 @admin.register(CompanyWallet)
 class CompanyWalletAdmin(admin.ModelAdmin):
-    list_display = ['id', 'balance', 'charges_balance']
+    list_display = ['id', 'balance', 'get_live_balance', 'charges_balance']
     readonly_fields = []
+    inlines = [CompanyWalletShardInline]
+
+    def get_live_balance(self, obj):
+        return obj.get_balance()
+    get_live_balance.short_description = 'Live Balance'
 
 @admin.register(Plan)
 class PlanAdmin(admin.ModelAdmin):
-    list_display = ['name', 'price', 'direct', 'matching']
+    list_display = ['name', 'price', 'direct', 'matching', 'daily_pair_cap']
 
 @admin.register(Level)
 class LevelAdmin(admin.ModelAdmin):
@@ -21,13 +39,51 @@ class LevelAdmin(admin.ModelAdmin):
 
 @admin.register(RankAndRewards)
 class RankAdmin(admin.ModelAdmin):
-    list_display = ['rank_no', 'rank_name', 'pairs', 'amount', 'royalty']
+    list_display = ['rank_no', 'rank_name', 'pairs', 'amount', 'royalty', 'daily_pair_cap']
+
+class RelocateSubtreeForm(forms.Form):
+    new_head = forms.CharField(label='New head username')
+    position = forms.ChoiceField(choices=Member.Position.choices)
+
+    def clean_new_head(self):
+        try:
+            return Member.objects.get(user__username=self.cleaned_data['new_head'])
+        except Member.DoesNotExist:
+            raise forms.ValidationError("No member with this username.")
 
 @admin.register(Member)
 class MemberAdmin(admin.ModelAdmin):
     list_display = ['user', 'position', 'get_head_member_username', 'get_sponsor_username']
     search_fields = ['user__username', 'user__email', 'sponsor__user__username']
-    readonly_fields = ['joined_on', 'last_updated']
+    # placement pointers are only changed through the "relocate subtree" action,
+    # which also repairs the closure index, counters, tails and paths
+    readonly_fields = ['joined_on', 'last_updated', 'head_member', 'position', 'left', 'right']
+    actions = ['relocate_subtree']
+
+    def relocate_subtree(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, "Select exactly one member to relocate.", level=messages.ERROR)
+            return None
+        member = queryset.get()
+        form = RelocateSubtreeForm(request.POST if 'apply' in request.POST else None)
+        if form.is_valid():
+            new_head, position = form.cleaned_data['new_head'], form.cleaned_data['position']
+            try:
+                old_head, _ = relocate_subtree(member, new_head, position)
+            except ValidationError as exc:
+                self.message_user(request, f"Nothing was moved: {' '.join(exc.messages)}", level=messages.ERROR)
+                return None
+            self.message_user(request, f"{member} and their downline moved from {old_head} to {position} of {new_head}.")
+            return None
+        return TemplateResponse(request, 'admin/mlm/member/relocate_subtree.html', {
+            **self.admin_site.each_context(request),
+            'title': 'Relocate subtree',
+            'opts': self.model._meta,
+            'member': member,
+            'form': form,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+    relocate_subtree.short_description = "Relocate selected member with their downline"
 
     def get_sponsor_username(self, obj):
         return obj.sponsor.user.username if obj.sponsor and obj.sponsor.user else '-'
@@ -48,16 +104,62 @@ class MemberPlanAdmin(admin.ModelAdmin):
     actions = ['mark_completed']
 
     def mark_completed(self, request, queryset):
-        for obj in queryset:
-            obj.mark_completed()
-        self.message_user(request, "Selected plans marked completed and processed.")
+        try:
+            results = process_commissions_for_plans(queryset)
+        except Exception as exc:
+            self.message_user(request, f"Nothing was processed: {exc}", level=messages.ERROR)
+            return
+        for plan_id, result in results.items():
+            if isinstance(result, dict):
+                detail = (f"direct ₹{result['direct_paid']}, level ₹{result['level_paid_total']}, "
+                          f"resale ₹{result['resale_paid_total']}")
+            else:
+                detail = result
+            self.message_user(request, f"Plan #{plan_id}: {detail}")
+        self.message_user(request, f"{len(results)} selected plans marked completed and processed.")
     mark_completed.short_description = "Mark selected plans as completed"
 
+@admin.register(BinaryClosing)
+class BinaryClosingAdmin(admin.ModelAdmin):
+    list_display = ['period_end', 'plans_processed', 'members_credited', 'pairs', 'pairs_flushed', 'amount', 'created_at']
+    readonly_fields = ['period_start', 'period_end', 'plans_processed', 'members_credited', 'pairs', 'pairs_flushed',
+                       'amount', 'volume_matched', 'created_at']
+
+@admin.register(FlushedPairs)
+class FlushedPairsAdmin(admin.ModelAdmin):
+    list_display = ['member', 'date', 'pairs', 'daily_cap', 'closing', 'created_at']
+    list_filter = ['date']
+    readonly_fields = ['member', 'closing', 'date', 'pairs', 'daily_cap', 'created_at']
+
+@admin.register(CommissionJob)
+class CommissionJobAdmin(admin.ModelAdmin):
+    list_display = ['member_plan', 'status', 'attempts', 'updated_at']
+    list_filter = ['status']
+    readonly_fields = ['member_plan', 'attempts', 'result', 'last_error', 'created_at', 'updated_at']
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        # a manual retry ignores MLM_COMMISSION_MAX_ATTEMPTS; finished jobs are never paid twice
+        job_ids = list(queryset.exclude(status=CommissionJob.STATUS_DONE).order_by('pk').values_list('pk', flat=True))
+        failed = 0
+        for job_id in job_ids:
+            job = run_commission_job(job_id)
+            if job.status == CommissionJob.STATUS_FAILED:
+                failed += 1
+                self.message_user(request, f"Job #{job_id} failed again: {job.last_error}", level=messages.ERROR)
+        self.message_user(request, f"{len(job_ids) - failed} of {len(job_ids)} selected job(s) processed.")
+    retry_jobs.short_description = "Retry selected jobs"
+
 @admin.register(IncomeHistory)
 class IncomeHistoryAdmin(admin.ModelAdmin):
     list_display = ['member', 'income_type', 'amount', 'created_at']
     list_filter = ['income_type']
 
+@admin.register(IncomeDailyRollup)
+class IncomeDailyRollupAdmin(admin.ModelAdmin):
+    list_display = ['member', 'date', 'income_type', 'amount', 'count']
+    list_filter = ['income_type', 'date']
+
 @admin.register(WalletTransaction)
 class WalletTransactionAdmin(admin.ModelAdmin):
     list_display = ['user', 'transaction_type', 'amount', 'balance_after', 'timestamp']
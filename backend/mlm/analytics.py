@@ -0,0 +1,169 @@
+# mlm/analytics.py
+"""
+Array-backed, in-memory view of the binary placement tree for reports and simulations.
+
+TreeArrays.load() reads only the id / head_member / left / right / status columns into
+flat NumPy arrays (about 30 bytes per member), so whole-tree questions such as leg
+sizes, active counts, pair counts, depth distribution or k-th ancestors are answered
+with vectorized passes instead of one Django model instance per member.
+"""
+from array import array
+import numpy as np
+from .models import Member
+
+NO_NODE = -1
+
+
+class TreeArrays:
+    """
+    Node i of the tree is member ids[i]. parent/left/right/head hold node indexes
+    (NO_NODE when empty); parent is derived from the left/right pointers, which are the
+    placement truth, while head mirrors head_member_id as stored.
+    """
+
+    def __init__(self, ids, head, left, right, active):
+        self.ids = ids
+        self.head = head
+        self.left = left
+        self.right = right
+        self.active = active
+        self.size = len(ids)
+
+        self.parent = np.full(self.size, NO_NODE, dtype=np.int32)
+        has_left, has_right = left >= 0, right >= 0
+        self.parent[left[has_left]] = np.nonzero(has_left)[0]
+        self.parent[right[has_right]] = np.nonzero(has_right)[0]
+
+        self._levels = None
+        self._depth = None
+
+    @classmethod
+    def load(cls, queryset=None, chunk_size=50000):
+        """Stream the tree columns of `queryset` (default: all members) into arrays."""
+        queryset = queryset if queryset is not None else Member.objects.all()
+        ids, heads, lefts, rights = array('q'), array('q'), array('q'), array('q')
+        active = array('b')
+        rows = queryset.order_by('pk').values_list('pk', 'head_member_id', 'left_id', 'right_id', 'status')
+        for pk, head_id, left_id, right_id, status in rows.iterator(chunk_size=chunk_size):
+            ids.append(pk)
+            heads.append(head_id or 0)
+            lefts.append(left_id or 0)
+            rights.append(right_id or 0)
+            active.append(status == Member.Status.ACTIVE)
+
+        ids = np.frombuffer(ids, dtype=np.int64) if ids else np.zeros(0, dtype=np.int64)
+        return cls(
+            ids,
+            cls._to_index(ids, heads),
+            cls._to_index(ids, lefts),
+            cls._to_index(ids, rights),
+            np.frombuffer(active, dtype=np.int8).astype(bool) if active else np.zeros(0, dtype=bool),
+        )
+
+    @staticmethod
+    def _to_index(ids, refs):
+        """Map member ids (0 = none) to node indexes of the sorted `ids` array."""
+        refs = np.frombuffer(refs, dtype=np.int64) if refs else np.zeros(0, dtype=np.int64)
+        index = np.searchsorted(ids, refs)
+        index = np.minimum(index, max(len(ids) - 1, 0))
+        found = (refs > 0) & (ids[index] == refs) if len(ids) else np.zeros(0, dtype=bool)
+        return np.where(found, index, NO_NODE).astype(np.int32)
+
+    # ---------------------------
+    # lookups
+    # ---------------------------
+    def index_of(self, member_id):
+        i = int(np.searchsorted(self.ids, member_id))
+        if i >= self.size or self.ids[i] != member_id:
+            raise KeyError(member_id)
+        return i
+
+    def roots(self):
+        return np.nonzero(self.parent == NO_NODE)[0]
+
+    def levels(self):
+        """Node indexes grouped by depth, top-down (one vectorized step per level)."""
+        if self._levels is None:
+            levels = []
+            frontier = self.roots().astype(np.int32)
+            while len(frontier):
+                levels.append(frontier)
+                children = np.concatenate((self.left[frontier], self.right[frontier]))
+                frontier = children[children >= 0]
+            self._levels = levels
+        return self._levels
+
+    def depth(self):
+        """Depth of every node below its root (roots are 0)."""
+        if self._depth is None:
+            depth = np.zeros(self.size, dtype=np.int32)
+            for d, level in enumerate(self.levels()):
+                depth[level] = d
+            self._depth = depth
+        return self._depth
+
+    def depth_distribution(self):
+        """Number of members at each depth."""
+        return np.bincount(self.depth(), minlength=len(self.levels()))
+
+    # ---------------------------
+    # subtree aggregates
+    # ---------------------------
+    def subtree_sum(self, values):
+        """Sum of `values` over every node's subtree (node included), bottom-up by level."""
+        totals = np.array(values, dtype=np.int64 if np.asarray(values).dtype.kind in 'biu' else np.float64)
+        for level in reversed(self.levels()[1:]):
+            np.add.at(totals, self.parent[level], totals[level])
+        return totals
+
+    def _legs(self, totals):
+        zero = np.zeros(1, dtype=totals.dtype)
+        padded = np.concatenate((totals, zero))  # index NO_NODE (-1) reads the trailing zero
+        return padded[self.left], padded[self.right]
+
+    def subtree_sizes(self):
+        return self.subtree_sum(np.ones(self.size, dtype=np.int64))
+
+    def leg_sizes(self):
+        """(left_count, right_count) arrays as Member stores them."""
+        return self._legs(self.subtree_sizes())
+
+    def active_leg_counts(self):
+        """(left_active_count, right_active_count) arrays."""
+        return self._legs(self.subtree_sum(self.active))
+
+    def pair_counts(self):
+        """Matching pairs every member has earned on head counts: min of the active legs."""
+        left_active, right_active = self.active_leg_counts()
+        return np.minimum(left_active, right_active)
+
+    # ---------------------------
+    # ancestors
+    # ---------------------------
+    def kth_ancestor(self, k, nodes=None):
+        """k-th ancestor of each node (NO_NODE above the root), by pointer doubling."""
+        nodes = np.arange(self.size, dtype=np.int32) if nodes is None else np.asarray(nodes, dtype=np.int32)
+        jump = np.concatenate((self.parent, [NO_NODE])).astype(np.int32)  # jump[-1] keeps NO_NODE fixed
+        result = nodes.copy()
+        while k and len(result):
+            if k & 1:
+                result = jump[result]
+            k >>= 1
+            if k:
+                jump = jump[jump]
+                jump[-1] = NO_NODE
+        return result
+
+    def ancestors(self, member_id, max_depth=None):
+        """Member ids above member_id, nearest first."""
+        chain = []
+        node = self.parent[self.index_of(member_id)]
+        while node != NO_NODE and (max_depth is None or len(chain) < max_depth):
+            chain.append(int(self.ids[node]))
+            node = self.parent[node]
+        return chain
+
+    def is_in_downline(self, member_id, ancestor_id):
+        node, ancestor = self.index_of(member_id), self.index_of(ancestor_id)
+        gap = int(self.depth()[node] - self.depth()[ancestor])
+        return gap > 0 and int(self.kth_ancestor(gap, [node])[0]) == ancestor
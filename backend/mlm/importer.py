@@ -0,0 +1,324 @@
+# mlm/importer.py
+"""
+Bulk member import: a partner network given as rows of (username, sponsor, position, ...)
+is placed in memory first, in dependency order (sponsors before the members they sponsor),
+with the same rules as a registration: an explicit position goes to the outermost slot of
+that leg, a blank one to the smaller leg. Users, Members, left/right links, tail pointers,
+paths, placement and sponsor closure rows and leg counters are then written with bulk
+statements in one transaction.
+"""
+import heapq
+from collections import defaultdict
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from .models import Member, MemberClosure, SponsorClosure, REFERRAL_CACHE_KEY
+
+LEFT, RIGHT = Member.Position.LEFT, Member.Position.RIGHT
+SLOTS = {LEFT: 'left', RIGHT: 'right'}
+
+
+class MemberImport:
+    """
+    Tree keys are member pks (int) for existing members and usernames (str) for imported rows.
+    Call plan() (validates and places in memory; errors end up in .errors), then save().
+    """
+
+    def __init__(self, rows, batch_size=5000):
+        self.rows = rows
+        self.batch_size = batch_size
+        self.errors = []
+        self.placements = []  # (username, sponsor key, head key, side) in placement order
+        self.roots = []  # imported rows without sponsor
+
+        self._existing = {}  # pk -> Member (existing sponsors)
+        self._existing_names = {}  # pk -> username, for reports
+        self._base_tails = {}  # (pk, side) -> tail pk read from the database
+        self._children = {}  # (key, side) -> key placed there by this import
+        self._tails = {}  # (key, side) -> current tail key
+        self._head_of = {}  # new key -> (head key, side)
+        self._counts = {}  # new key -> [left, right] (imported members below it)
+        self._attached = defaultdict(int)  # (existing pk, side) -> imported members hung there
+        self._legs_below = defaultdict(dict)  # existing sponsor pk -> {existing attach pk: leg}
+
+    # ---------------------------
+    # planning
+    # ---------------------------
+    def plan(self):
+        order = self._validate()
+        if self.errors:
+            return False
+        self._load_existing_sponsors()
+        for index in order:
+            row = self.rows[index]
+            username, sponsor = row['username'], row['sponsor']
+            if sponsor is None:
+                self.roots.append(username)
+                continue
+            side = row['position'] or self._smaller_leg(sponsor)
+            head = self._tail(sponsor, side)
+            self._children[(head, side)] = username
+            self._head_of[username] = (head, side)
+            self._counts[username] = [0, 0]
+            self._propagate(username)
+            self.placements.append((username, sponsor, head, side))
+        return True
+
+    def _validate(self):
+        User = get_user_model()
+        seen, phones = {}, set()
+        for number, row in enumerate(self.rows, start=2):  # line 1 is the CSV header
+            row['line'] = number
+            username = row.get('username') or ''
+            if not username:
+                self.errors.append(f'line {number}: username is required')
+            elif username in seen:
+                self.errors.append(f'line {number}: duplicate username "{username}" (also on line {seen[username]})')
+            seen.setdefault(username, number)
+            position = (row.get('position') or '').upper()
+            if position not in ('', LEFT, RIGHT):
+                self.errors.append(f'line {number}: position must be LEFT, RIGHT or empty')
+            row['position'] = position or None
+            row['phone'] = row.get('phone') or None
+            if row['phone'] and row['phone'] in phones:
+                self.errors.append(f'line {number}: duplicate phone "{row["phone"]}"')
+            phones.add(row['phone'])
+
+        taken = set(User.objects.filter(username__in=list(seen)).values_list('username', flat=True))
+        for username in taken:
+            self.errors.append(f'line {seen[username]}: username "{username}" already exists')
+        for phone in User.objects.filter(phone__in=[p for p in phones if p]).values_list('phone', flat=True):
+            self.errors.append(f'phone "{phone}" already belongs to an existing user')
+
+        # sponsors: another row of the file, or an existing member
+        referenced = {row['sponsor'] for row in self.rows if row.get('sponsor')} - set(seen)
+        existing = dict(Member.objects.filter(user__username__in=referenced).values_list('user__username', 'pk'))
+        sponsored_by = defaultdict(list)
+        ready = []
+        for index, row in enumerate(self.rows):
+            sponsor = row.get('sponsor') or None
+            if sponsor in seen:
+                sponsored_by[sponsor].append(index)
+            elif sponsor is None or sponsor in existing:
+                row['sponsor'] = existing.get(sponsor)
+                ready.append(index)
+            else:
+                self.errors.append(f'line {row["line"]}: unknown sponsor "{sponsor}"')
+        if self.errors:
+            return []
+
+        # dependency order, otherwise file order
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            index = heapq.heappop(ready)
+            order.append(index)
+            for child in sponsored_by.pop(self.rows[index]['username'], []):
+                heapq.heappush(ready, child)
+        for children in sponsored_by.values():
+            for index in children:
+                self.errors.append(f'line {self.rows[index]["line"]}: sponsor chain loops back to this row')
+        return order
+
+    def _load_existing_sponsors(self):
+        sponsor_ids = {row['sponsor'] for row in self.rows if isinstance(row['sponsor'], int)}
+        self._existing = Member.objects.select_related('user').in_bulk(sponsor_ids)
+        for pk, member in self._existing.items():
+            self._existing_names[pk] = member.user.username
+            for side in SLOTS:
+                self._base_tails[(pk, side)] = member.get_leg_tail(side).pk
+        attach_points = set(self._base_tails.values())
+        links = MemberClosure.objects.filter(ancestor_id__in=sponsor_ids, descendant_id__in=attach_points, depth__gte=1)
+        for ancestor_id, descendant_id, leg in links.values_list('ancestor_id', 'descendant_id', 'leg'):
+            self._legs_below[ancestor_id][descendant_id] = leg
+        self._existing_names.update(
+            Member.objects.filter(pk__in=attach_points).values_list('pk', 'user__username')
+        )
+
+    def _tail(self, key, side):
+        tail = self._tails.get((key, side))
+        if tail is None:
+            tail = self._base_tails.get((key, side), key)  # an attach point's own slot is the vacant one
+        while (tail, side) in self._children:
+            tail = self._children[(tail, side)]
+        self._tails[(key, side)] = tail
+        return tail
+
+    def _smaller_leg(self, sponsor):
+        if isinstance(sponsor, int):
+            member = self._existing[sponsor]
+            left = member.left_count + self._attached[(sponsor, LEFT)]
+            right = member.right_count + self._attached[(sponsor, RIGHT)]
+            for attach_id, leg in self._legs_below[sponsor].items():
+                added = self._attached[(attach_id, LEFT)] + self._attached[(attach_id, RIGHT)]
+                if leg == LEFT:
+                    left += added
+                else:
+                    right += added
+        else:
+            left, right = self._counts.get(sponsor, (0, 0))
+        return LEFT if left <= right else RIGHT
+
+    def _propagate(self, key):
+        """Count `key` in the legs of its imported ancestors, up to where the import hangs off the tree."""
+        while key in self._head_of:
+            head, side = self._head_of[key]
+            if isinstance(head, int):
+                self._attached[(head, side)] += 1
+                return
+            self._counts[head][0 if side == LEFT else 1] += 1
+            key = head
+
+    # ---------------------------
+    # reporting
+    # ---------------------------
+    def name(self, key):
+        return self._existing_names.get(key, key) if isinstance(key, int) else key
+
+    def report(self):
+        under_existing = sum(1 for _, sponsor, _, _ in self.placements if isinstance(sponsor, int))
+        lines = [
+            f'{len(self.rows)} row(s): {len(self.placements)} placement(s) '
+            f'({under_existing} directly under existing members), {len(self.roots)} without sponsor.'
+        ]
+        for username, sponsor, head, side in self.placements:
+            lines.append(f'{username}: sponsor {self.name(sponsor)}, placed {side} of {self.name(head)}')
+        return lines
+
+    # ---------------------------
+    # writing
+    # ---------------------------
+    @transaction.atomic
+    def save(self):
+        User = get_user_model()
+        attach_points = {head for _, _, head, _ in self.placements if isinstance(head, int)}
+
+        # lock the rows this import writes in one pk-ordered statement (as place_many does)
+        ancestor_ids = set(MemberClosure.objects.filter(descendant_id__in=attach_points)
+                           .values_list('ancestor_id', flat=True))
+        locked = Member.objects.select_for_update().filter(pk__in=attach_points | ancestor_ids).order_by('pk')
+        locked = {member.pk: member for member in locked}
+        for (head, side), _ in self._children.items():
+            if isinstance(head, int) and getattr(locked[head], f'{SLOTS[side]}_id'):
+                raise ValueError(f'{self.name(head)} got a {side} member while importing; run the import again.')
+
+        users = []
+        for row in self.rows:
+            user = User(username=row['username'], email=row.get('email') or '', phone=row['phone'],
+                        first_name=row.get('first_name') or '', last_name=row.get('last_name') or '',
+                        role=User.Role.MEMBER)
+            user.password = make_password(row['password']) if row.get('password') else make_password(None)
+            users.append(user)
+        users = User.objects.bulk_create(users, batch_size=self.batch_size)
+        members = Member.objects.bulk_create([Member(user=user) for user in users], batch_size=self.batch_size)
+        pks = {user.username: member.pk for user, member in zip(users, members)}
+
+        def pk(key):
+            return key if isinstance(key, int) else pks[key]
+
+        # materialized paths in placement order (heads first)
+        paths = {}
+        existing_paths = {pk: locked[pk].get_path() for pk in attach_points}
+        for username, _, head, _ in self.placements:
+            head_path = existing_paths[head] if isinstance(head, int) else paths.get(head, f'{pks[head]}/')
+            paths[username] = f'{head_path}{pks[username]}/'
+
+        # pointers of the imported members
+        by_username = {row['username']: row for row in self.rows}
+        updates = []
+        for username, member in zip((user.username for user in users), members):
+            sponsor = by_username[username]['sponsor']
+            head, side = self._head_of.get(username, (None, None))
+            member.sponsor_id = pk(sponsor) if sponsor is not None else None
+            member.head_member_id = pk(head) if head is not None else None
+            member.position = side
+            in_tree = head is not None or any((username, slot_side) in self._children for slot_side in SLOTS)
+            member.path = paths.get(username, f'{member.pk}/' if in_tree else '')
+            member.depth = max(member.path.count('/') - 1, 0)
+            for slot_side, slot in SLOTS.items():
+                child = self._children.get((username, slot_side))
+                setattr(member, f'{slot}_id', pks[child] if child else None)
+                setattr(member, f'{slot}_tail_id', pks[self._tail(username, slot_side)] if in_tree else None)
+            updates.append(member)
+        Member.objects.bulk_update(
+            updates, ['sponsor', 'head_member', 'position', 'left', 'right', 'left_tail', 'right_tail', 'path', 'depth'],
+            batch_size=self.batch_size,
+        )
+
+        # existing members the import hangs off: new child links and moved leg tails
+        for side, slot in SLOTS.items():
+            heads = [Member(pk=head, **{f'{slot}_id': pks[child]})
+                     for (head, child_side), child in self._children.items() if isinstance(head, int) and child_side == side]
+            if heads:
+                Member.objects.bulk_update(heads, [slot])
+            for head in heads:
+                tail_field = f'{slot}_tail'
+                Member.objects.filter(Q(**{tail_field: head.pk}) | Q(pk=head.pk)).update(
+                    **{tail_field: pks[self._tail(head.pk, side)]})
+
+        MemberClosure.objects.bulk_create(self._closure_rows(pk, attach_points), batch_size=self.batch_size,
+                                          ignore_conflicts=True)
+        SponsorClosure.objects.bulk_create(self._sponsor_rows(pk), batch_size=self.batch_size, ignore_conflicts=True)
+        placed = [pks[username] for username, *_ in self.placements]
+        MemberClosure.add_to_ancestors_of_many(placed, 'left_count', 'right_count')
+        return {'created': len(members), 'placed': len(placed)}
+
+    def _closure_rows(self, pk, attach_points):
+        """Closure rows of every imported member, generated by walking up the in-memory placement."""
+        existing_links = defaultdict(list)
+        for ancestor_id, descendant_id, depth, leg in (MemberClosure.objects.filter(descendant_id__in=attach_points)
+                                                       .values_list('ancestor_id', 'descendant_id', 'depth', 'leg')):
+            existing_links[descendant_id].append((ancestor_id, depth, leg))
+        for attach_id in attach_points:
+            if not existing_links[attach_id]:  # unindexed root, indexed on the fly as insert_node does
+                existing_links[attach_id].append((attach_id, 0, None))
+                yield MemberClosure(ancestor_id=attach_id, descendant_id=attach_id, depth=0, leg=None)
+
+        heads = {head for _, _, head, _ in self.placements}
+        for username in [username for username, *_ in self.placements] + [r for r in self.roots if r in heads]:
+            member_id = pk(username)
+            yield MemberClosure(ancestor_id=member_id, descendant_id=member_id, depth=0, leg=None)
+            key, depth = username, 0
+            while key in self._head_of:
+                head, side = self._head_of[key]
+                depth += 1
+                if isinstance(head, int):
+                    for ancestor_id, head_depth, leg in existing_links[head]:
+                        yield MemberClosure(ancestor_id=ancestor_id, descendant_id=member_id,
+                                            depth=head_depth + depth, leg=leg or side)
+                    break
+                yield MemberClosure(ancestor_id=pk(head), descendant_id=member_id, depth=depth, leg=side)
+                key = head
+
+    def _sponsor_rows(self, pk):
+        """SponsorClosure rows of every imported member in the referral tree, walking up the sponsors."""
+        sponsor_of = {row['username']: row['sponsor'] for row in self.rows}
+        existing_links = defaultdict(list)
+        for ancestor_id, descendant_id, depth in (SponsorClosure.objects.filter(descendant_id__in=self._existing)
+                                                  .values_list('ancestor_id', 'descendant_id', 'depth')):
+            existing_links[descendant_id].append((ancestor_id, depth))
+        for sponsor_id in self._existing:
+            if not existing_links[sponsor_id]:  # unindexed referral root
+                existing_links[sponsor_id].append((sponsor_id, 0))
+                yield SponsorClosure(ancestor_id=sponsor_id, descendant_id=sponsor_id, depth=0)
+        cache.delete_many([REFERRAL_CACHE_KEY.format(member_id=ancestor_id)
+                           for links in existing_links.values() for ancestor_id, _ in links])
+
+        referrers = {sponsor for sponsor in sponsor_of.values() if isinstance(sponsor, str)}
+        for username, sponsor in sponsor_of.items():
+            if sponsor is None and username not in referrers:
+                continue  # plain profile, as a registration without sponsor
+            member_id = pk(username)
+            yield SponsorClosure(ancestor_id=member_id, descendant_id=member_id, depth=0)
+            key, depth = username, 0
+            while sponsor_of.get(key) is not None:
+                sponsor = sponsor_of[key]
+                depth += 1
+                if isinstance(sponsor, int):
+                    for ancestor_id, sponsor_depth in existing_links[sponsor]:
+                        yield SponsorClosure(ancestor_id=ancestor_id, descendant_id=member_id, depth=sponsor_depth + depth)
+                    break
+                yield SponsorClosure(ancestor_id=pk(sponsor), descendant_id=member_id, depth=depth)
+                key = sponsor
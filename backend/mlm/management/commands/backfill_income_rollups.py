@@ -0,0 +1,45 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from mlm.models import IncomeHistory, IncomeDailyRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild IncomeDailyRollup from IncomeHistory, streaming the history in primary-key chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='History rows read per chunk (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        # Rows written after this point are rolled up live by the writers themselves
+        with transaction.atomic():
+            last_pk = IncomeHistory.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            IncomeDailyRollup.objects.all().delete()
+
+        after, scanned = 0, 0
+        while True:
+            chunk = list(
+                IncomeHistory.objects.filter(pk__gt=after, pk__lte=last_pk).order_by('pk')
+                .only('pk', 'member_id', 'income_type', 'amount', 'created_at')[:chunk_size]
+            )
+            if not chunk:
+                break
+            by_date = defaultdict(list)
+            for history in chunk:
+                by_date[timezone.localdate(history.created_at)].append(history)
+            with transaction.atomic():
+                for date, histories in by_date.items():
+                    IncomeDailyRollup.add_many(histories, date=date)
+            after = chunk[-1].pk
+            scanned += len(chunk)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{scanned} history row(s) rolled into {IncomeDailyRollup.objects.count()} daily rollup(s).'))
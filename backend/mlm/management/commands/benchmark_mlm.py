@@ -0,0 +1,95 @@
+import json
+import random
+import time
+from decimal import Decimal
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext
+from mlm.models import CompanyWallet, Member, MemberPlan, Plan, update_matching_income
+from mlm.services import process_commissions_for_purchase
+
+HOT_PATHS = ('find_placement', 'assign_new_member', 'process_commissions_for_purchase', 'update_matching_income')
+
+
+class Command(BaseCommand):
+    help = 'Time the MLM hot paths on the current tree and report latency percentiles and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Calls per hot path (default: 50)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for the sampled members')
+        parser.add_argument('--keep', action='store_true',
+                            help='Commit the members, purchases and payouts the benchmark creates (default: roll back)')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON for tracking over time')
+
+    def handle(self, *args, **options):
+        bounds = Member.objects.aggregate(low=Min('pk'), high=Max('pk'))
+        plan = Plan.objects.order_by('pk').first()
+        if bounds['low'] is None or plan is None:
+            raise CommandError('Nothing to benchmark: generate a tree first (manage.py generate_mlm_tree).')
+        self.rng = random.Random(options['seed'])
+        self.bounds = bounds
+        samples = {path: ([], []) for path in HOT_PATHS}  # (seconds, queries)
+
+        with transaction.atomic():
+            size = Member.objects.count()
+            # payouts must not fail on an unfunded company wallet (rolled back with the rest)
+            CompanyWallet.objects.get_or_create(pk=1)[0].add_to_wallet(Decimal('1000000000.00'))
+            User = get_user_model()
+            for n in range(options['iterations']):
+                member = self._random_member()
+                self._measure(samples['find_placement'], member.find_placement, self._random_side())
+
+                user = User(username=f'benchmark-{time.time_ns()}-{n}', role=User.Role.MEMBER)
+                user.set_unusable_password()
+                user.save()
+                new_member = Member.objects.create(user=user)
+                self._measure(samples['assign_new_member'], self._random_member().assign_new_member,
+                              new_member, self._random_side(), True)
+
+                member_plan = MemberPlan.objects.create(member=self._random_member(), plan=plan)
+                self._measure(samples['process_commissions_for_purchase'], process_commissions_for_purchase, member_plan)
+                self._measure(samples['update_matching_income'], update_matching_income, member_plan)
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        report = {'members': size, 'iterations': options['iterations'], 'paths': {}}
+        for path, (seconds, queries) in samples.items():
+            ms = np.array(seconds) * 1000
+            report['paths'][path] = {
+                'p50_ms': round(float(np.percentile(ms, 50)), 3),
+                'p95_ms': round(float(np.percentile(ms, 95)), 3),
+                'p99_ms': round(float(np.percentile(ms, 99)), 3),
+                'max_ms': round(float(ms.max()), 3),
+                'queries_avg': round(float(np.mean(queries)), 1),
+                'queries_max': int(max(queries)),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f'{size} member(s), {options["iterations"]} iteration(s) per path')
+        self.stdout.write(f'{"path":<34}{"p50":>10}{"p95":>10}{"p99":>10}{"max":>10}{"queries":>10}')
+        for path, row in report['paths'].items():
+            self.stdout.write(
+                f'{path:<34}{row["p50_ms"]:>9.2f}ms{row["p95_ms"]:>8.2f}ms{row["p99_ms"]:>8.2f}ms'
+                f'{row["max_ms"]:>8.2f}ms{row["queries_avg"]:>10}'
+            )
+
+    def _random_member(self):
+        # uniform pk probe: O(log n) per sample, no id list held in memory
+        pk = self.rng.randint(self.bounds['low'], self.bounds['high'])
+        return Member.objects.filter(pk__gte=pk).order_by('pk').first() or Member.objects.order_by('pk').first()
+
+    def _random_side(self):
+        return self.rng.choice((Member.Position.LEFT, Member.Position.RIGHT))
+
+    def _measure(self, sample, func, *args):
+        seconds, queries = sample
+        with CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            func(*args)
+            seconds.append(time.perf_counter() - started)
+        queries.append(len(ctx.captured_queries))
@@ -0,0 +1,116 @@
+import random
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from mlm.models import Member, MemberClosure, MemberPlan, Plan, Level
+
+SHAPES = ('balanced', 'skewed', 'chain')
+
+
+def _heap_edges(nodes):
+    """(child, parent, position) edges laying `nodes` out as a complete binary tree under nodes[0]."""
+    for j in range(1, len(nodes)):
+        yield nodes[j], nodes[(j - 1) // 2], Member.Position.LEFT if j % 2 else Member.Position.RIGHT
+
+
+def tree_edges(count, shape, skew=0.8):
+    """Placement edges between node numbers 0..count-1 (0 is the root) for the given shape."""
+    if shape == 'chain':
+        return [(i, i - 1, Member.Position.LEFT) for i in range(1, count)]
+    if shape == 'balanced':
+        return list(_heap_edges(range(count)))
+    # skewed: a strong left leg holding `skew` of the downline and a weak right leg, each balanced
+    split = 1 + round((count - 1) * skew)
+    left_leg, right_leg = range(1, split), range(split, count)
+    edges = list(_heap_edges(left_leg)) + list(_heap_edges(right_leg))
+    if left_leg:
+        edges.append((left_leg[0], 0, Member.Position.LEFT))
+    if right_leg:
+        edges.append((right_leg[0], 0, Member.Position.RIGHT))
+    return edges
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic placement tree (balanced, skewed or chain) with plan purchases for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000, help='Members to create (default: 1000)')
+        parser.add_argument('--shape', choices=SHAPES, default='balanced', help='Tree shape (default: balanced)')
+        parser.add_argument('--skew', type=float, default=0.8,
+                            help='Share of the downline in the left leg for --shape skewed (default: 0.8)')
+        parser.add_argument('--purchase-ratio', type=float, default=0.6,
+                            help='Share of members with a completed plan purchase (default: 0.6)')
+        parser.add_argument('--prefix', default='bench', help='Username prefix (default: bench)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible trees')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk write (default: 5000)')
+
+    def handle(self, *args, **options):
+        count, batch_size, prefix = options['members'], options['batch_size'], options['prefix']
+        if count < 1:
+            raise CommandError('--members must be at least 1.')
+        User = get_user_model()
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f'Users named "{prefix}*" already exist; pick another --prefix.')
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            plan, created = Plan.objects.get_or_create(
+                name='Benchmark', defaults={'price': Decimal('499.00'), 'direct': Decimal('50.00'), 'matching': Decimal('10.00')}
+            )
+            if created:
+                Level.objects.bulk_create([
+                    Level(plan=plan, level=level, distributed_amount=Decimal('2.00'), resale_percentage=Decimal('0.50'))
+                    for level in range(1, 11)
+                ])
+
+            # Users and members in bulk; bulk_create skips the per-row save/signal overhead
+            member_ids = []
+            for start in range(0, count, batch_size):
+                users = []
+                for i in range(start, min(start + batch_size, count)):
+                    user = User(username=f'{prefix}{i}', role=User.Role.MEMBER)
+                    user.set_unusable_password()
+                    users.append(user)
+                users = User.objects.bulk_create(users)
+                members = Member.objects.bulk_create([Member(user=user) for user in users])
+                member_ids.extend(member.pk for member in members)
+
+            # Placement pointers (sponsor = placement head)
+            updates = {pk: Member(pk=pk) for pk in member_ids}
+            for child, parent, position in tree_edges(count, options['shape'], options['skew']):
+                child_id, parent_id = member_ids[child], member_ids[parent]
+                updates[child_id].head_member_id = updates[child_id].sponsor_id = parent_id
+                updates[child_id].position = position
+                if position == Member.Position.LEFT:
+                    updates[parent_id].left_id = child_id
+                else:
+                    updates[parent_id].right_id = child_id
+            Member.objects.bulk_update(
+                list(updates.values()), ['head_member', 'sponsor', 'position', 'left', 'right'], batch_size=batch_size
+            )
+
+            # Completed purchases activate their buyers
+            buyers = sorted(rng.sample(member_ids, round(count * options['purchase_ratio'])))
+            now = timezone.now()
+            for start in range(0, len(buyers), batch_size):
+                chunk = buyers[start:start + batch_size]
+                MemberPlan.objects.bulk_create([
+                    MemberPlan(member_id=pk, plan=plan, status=MemberPlan.STATUS_COMPLETED, completed_at=now)
+                    for pk in chunk
+                ])
+                Member.objects.filter(pk__in=chunk).update(status=Member.Status.ACTIVE)
+
+        # Closure rows, leg tails, subtree counters, paths and the sponsor index from the pointers just written
+        call_command('rebuild_tree_index', batch_size=batch_size, stdout=self.stdout)
+        call_command('rebuild_tree_counters', batch_size=batch_size, stdout=self.stdout)
+        call_command('rebuild_tree_paths', batch_size=batch_size, stdout=self.stdout)
+        call_command('rebuild_sponsor_index', batch_size=batch_size, stdout=self.stdout)
+        # Leg business volume of the generated purchases, now that the closure rows exist
+        MemberClosure.add_plan_volume(MemberPlan.objects.filter(plan=plan, member__user__username__startswith=prefix).values('pk'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated a {options["shape"]} tree of {count} member(s) rooted at #{member_ids[0]} '
+            f'with {len(buyers)} purchase(s).'
+        ))
@@ -0,0 +1,43 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from mlm.importer import MemberImport
+
+COLUMNS = ('username', 'email', 'first_name', 'last_name', 'phone', 'password', 'sponsor', 'position')
+
+
+class Command(BaseCommand):
+    help = ('Import members from a CSV (columns: ' + ', '.join(COLUMNS) + '; sponsor is a username from the file '
+            'or an existing member, position LEFT/RIGHT or empty for the smaller leg)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='Path of the CSV file')
+        parser.add_argument('--dry-run', action='store_true', help='Validate and report the placements without writing')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk statement (default: 5000)')
+
+    def handle(self, *args, **options):
+        with open(options['csv_file'], newline='', encoding='utf-8-sig') as handle:
+            reader = csv.DictReader(handle)
+            missing = {'username', 'sponsor'} - set(reader.fieldnames or ())
+            if missing:
+                raise CommandError(f'Missing column(s): {", ".join(sorted(missing))}')
+            rows = [{key: (value or '').strip() for key, value in row.items() if key in COLUMNS} for row in reader]
+
+        member_import = MemberImport(rows, batch_size=options['batch_size'])
+        if not member_import.plan():
+            for error in member_import.errors:
+                self.stderr.write(error)
+            raise CommandError(f'{len(member_import.errors)} problem(s) found, nothing imported.')
+
+        report = member_import.report()
+        self.stdout.write(report[0])
+        if options['dry_run']:
+            for line in report[1:]:
+                self.stdout.write(line)
+            self.stdout.write(self.style.WARNING('Dry run: nothing was written.'))
+            return
+
+        try:
+            result = member_import.save()
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(f'{result["created"]} member(s) created, {result["placed"]} placed.'))
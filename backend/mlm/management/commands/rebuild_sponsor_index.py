@@ -0,0 +1,63 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mlm.models import Member, SponsorClosure, REFERRAL_CACHE_KEY
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the sponsor (referral) tree index SponsorClosure from Member.sponsor'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk insert (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Load the bare sponsor relation once (no model instances)
+        referrals = {}
+        member_ids = []
+        for pk, sponsor_id in Member.objects.values_list('pk', 'sponsor_id').iterator(chunk_size=batch_size):
+            member_ids.append(pk)
+            if sponsor_id:
+                referrals.setdefault(sponsor_id, []).append(pk)
+        known = set(member_ids)
+        has_sponsor = {pk for children in referrals.values() for pk in children}
+        roots = [pk for pk in member_ids if pk not in has_sponsor]
+        # a member whose sponsor row is gone starts its own referral tree
+        roots += [pk for sponsor_id, children in referrals.items() if sponsor_id not in known for pk in children]
+        written = 0
+
+        with transaction.atomic():
+            SponsorClosure.objects.all().delete()
+            batch = []
+
+            # Iterative DFS; each stack entry carries its sponsor chain (root first)
+            for root in roots:
+                stack = [(root, [])]
+                while stack:
+                    node, chain = stack.pop()
+                    batch.append(SponsorClosure(ancestor_id=node, descendant_id=node, depth=0))
+                    depth = len(chain)
+                    for i, ancestor_id in enumerate(chain):
+                        batch.append(SponsorClosure(ancestor_id=ancestor_id, descendant_id=node, depth=depth - i))
+                    for child in referrals.get(node, ()):
+                        stack.append((child, chain + [node]))
+
+                    if len(batch) >= batch_size:
+                        SponsorClosure.objects.bulk_create(batch, batch_size=batch_size)
+                        written += len(batch)
+                        batch = []
+
+            if batch:
+                SponsorClosure.objects.bulk_create(batch, batch_size=batch_size)
+                written += len(batch)
+
+        cache.delete_many([REFERRAL_CACHE_KEY.format(member_id=pk) for pk in member_ids])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt sponsor index: {len(member_ids)} members, {written} closure rows.'
+        ))
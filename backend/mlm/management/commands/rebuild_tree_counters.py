@@ -0,0 +1,77 @@
+from array import array
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Value, When
+from mlm.analytics import TreeArrays
+from mlm.models import Member
+
+COUNTER_FIELDS = ('left_count', 'right_count', 'left_active_count', 'right_active_count')
+
+
+class Command(BaseCommand):
+    help = 'Recompute the left/right (active) leg counters of every member from the placement pointers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk update (default: 5000)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many members have drifted counters'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # The placement pointers and the stored counters are read from one snapshot, so
+        # expected - stored is the drift at that moment; on PostgreSQL that needs REPEATABLE
+        # READ (SET TRANSACTION must be the first statement, so only in a fresh transaction).
+        snapshot = connection.vendor == 'postgresql' and not connection.in_atomic_block
+        with transaction.atomic():
+            if snapshot:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            # Subtree sizes for the whole tree in one bottom-up pass over the loaded arrays
+            tree = TreeArrays.load(chunk_size=batch_size)
+            left_count, right_count = tree.leg_sizes()
+            left_active, right_active = tree.active_leg_counts()
+            expected = np.stack((left_count, right_count, left_active, right_active), axis=1)
+
+            stored = np.zeros_like(expected)
+            values = array('q')
+            rows = Member.objects.order_by('pk').values_list('pk', *COUNTER_FIELDS)
+            for row in rows.iterator(chunk_size=batch_size):
+                values.extend(row)
+        if values:
+            values = np.frombuffer(values, dtype=np.int64).reshape(-1, 1 + len(COUNTER_FIELDS))
+            # members placed since the load are left for the next run
+            index = np.searchsorted(tree.ids, values[:, 0])
+            known = index < tree.size
+            known[known] &= tree.ids[index[known]] == values[known, 0]
+            stored[index[known]] = values[known, 1:]
+
+        drifted = np.nonzero((stored != expected).any(axis=1))[0]
+        if options['dry_run']:
+            self.stdout.write(f'{len(drifted)} member(s) have drifted counters.')
+            return
+
+        # Corrections are applied as deltas (F(field) + expected - stored), not absolute values:
+        # placements and (de)activations committed after the snapshot incremented the same
+        # counters with F() and keep their share instead of being overwritten.
+        delta = expected - stored
+        for start in range(0, len(drifted), batch_size):
+            chunk = drifted[start:start + batch_size]
+            updates = {}
+            for column, field in enumerate(COUNTER_FIELDS):
+                whens = [When(pk=int(tree.ids[i]), then=Value(int(delta[i, column]))) for i in chunk if delta[i, column]]
+                if whens:
+                    updates[field] = F(field) + Case(*whens, default=Value(0), output_field=models.IntegerField())
+            with transaction.atomic():
+                Member.objects.filter(pk__in=[int(tree.ids[i]) for i in chunk]).update(**updates)
+
+        self.stdout.write(self.style.SUCCESS(f'Counters corrected for {len(drifted)} of {tree.size} member(s).'))
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mlm.models import Member, MemberClosure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the placement tree index (MemberClosure and leg tail pointers) from the left/right pointers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk insert (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Load the bare tree structure once (no model instances)
+        children = {}
+        current_tails = {}
+        has_parent = set()
+        member_ids = []
+        rows = Member.objects.values_list('pk', 'left_id', 'right_id', 'left_tail_id', 'right_tail_id')
+        for pk, left_id, right_id, left_tail_id, right_tail_id in rows.iterator(chunk_size=batch_size):
+            member_ids.append(pk)
+            children[pk] = (left_id, right_id)
+            current_tails[pk] = (left_tail_id, right_tail_id)
+            if left_id:
+                has_parent.add(left_id)
+            if right_id:
+                has_parent.add(right_id)
+
+        roots = [pk for pk in member_ids if pk not in has_parent]
+        written = 0
+        preorder = []
+
+        with transaction.atomic():
+            MemberClosure.objects.all().delete()
+            batch = []
+
+            # Iterative DFS; each stack entry carries its (ancestor_id, leg) path
+            for root in roots:
+                stack = [(root, [])]
+                while stack:
+                    node, path = stack.pop()
+                    preorder.append(node)
+                    batch.append(MemberClosure(ancestor_id=node, descendant_id=node, depth=0, leg=None))
+                    depth = len(path)
+                    for i, (ancestor_id, leg) in enumerate(path):
+                        batch.append(MemberClosure(ancestor_id=ancestor_id, descendant_id=node,
+                                                   depth=depth - i, leg=leg))
+                    left_id, right_id = children.get(node, (None, None))
+                    if right_id:
+                        stack.append((right_id, path + [(node, Member.Position.RIGHT)]))
+                    if left_id:
+                        stack.append((left_id, path + [(node, Member.Position.LEFT)]))
+
+                    if len(batch) >= batch_size:
+                        MemberClosure.objects.bulk_create(batch, batch_size=batch_size)
+                        written += len(batch)
+                        batch = []
+
+            if batch:
+                MemberClosure.objects.bulk_create(batch, batch_size=batch_size)
+                written += len(batch)
+
+            # Leg tails: children are resolved before parents in reverse pre-order
+            tails = {}
+            for node in reversed(preorder):
+                left_id, right_id = children[node]
+                tails[node] = (tails[left_id][0] if left_id else node,
+                               tails[right_id][1] if right_id else node)
+            stale = [
+                Member(pk=pk, left_tail_id=left_tail, right_tail_id=right_tail)
+                for pk, (left_tail, right_tail) in tails.items()
+                if current_tails[pk] != (left_tail, right_tail)
+            ]
+            Member.objects.bulk_update(stale, ['left_tail', 'right_tail'], batch_size=batch_size)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt tree index: {len(member_ids)} members, {written} closure rows, '
+            f'{len(stale)} leg tails repaired.'
+        ))
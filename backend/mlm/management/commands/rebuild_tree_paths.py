@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mlm.analytics import TreeArrays
+from mlm.models import Member
+
+
+class Command(BaseCommand):
+    help = 'Backfill the materialized path / depth of every member from the left/right pointers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows per bulk update (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Paths top-down, one level at a time: child path = head path + own id
+        tree = TreeArrays.load(chunk_size=batch_size)
+        paths = [''] * tree.size
+        for level in tree.levels():
+            for node in level.tolist():
+                parent = tree.parent[node]
+                paths[node] = f'{paths[parent] if parent >= 0 else ""}{tree.ids[node]}/'
+        depth = tree.depth()
+
+        stale = []
+        rows = Member.objects.order_by('pk').values_list('pk', 'path', 'depth')
+        for pk, path, stored_depth in rows.iterator(chunk_size=batch_size):
+            try:
+                node = tree.index_of(pk)
+            except KeyError:
+                continue  # placed after the load; it got its path at placement
+            if path != paths[node] or stored_depth != depth[node]:
+                stale.append(Member(pk=pk, path=paths[node], depth=int(depth[node])))
+
+        for start in range(0, len(stale), batch_size):
+            with transaction.atomic():
+                Member.objects.bulk_update(stale[start:start + batch_size], ['path', 'depth'])
+        self.stdout.write(self.style.SUCCESS(f'Paths rewritten for {len(stale)} of {tree.size} member(s).'))
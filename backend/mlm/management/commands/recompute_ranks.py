@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from mlm.services import recompute_ranks
+
+
+class Command(BaseCommand):
+    help = 'Re-evaluate every member against RankAndRewards and pay rewards for new ranks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Members evaluated per pass (default: 5000)'
+        )
+
+    def handle(self, *args, **options):
+        promoted = recompute_ranks(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{promoted} member(s) promoted.'))
@@ -0,0 +1,76 @@
+from concurrent.futures import ProcessPoolExecutor
+from django import db
+from django.core.management.base import BaseCommand
+from mlm.models import Member
+from mlm.services import reconcile_member_range
+
+
+def _close_inherited_connections():
+    # forked workers must not share the parent's database sockets
+    db.connections.close_all()
+
+
+def _member_ranges(chunk_size):
+    """Yield (after_pk, last_pk] keyset ranges of chunk_size members, reading only one pk per range."""
+    after = 0
+    while True:
+        last = (Member.objects.filter(pk__gt=after).order_by('pk')
+                .values_list('pk', flat=True)[chunk_size - 1:chunk_size].first())
+        if last is None:
+            last = Member.objects.filter(pk__gt=after).order_by('-pk').values_list('pk', flat=True).first()
+            if last is not None:
+                yield after, last
+            return
+        yield after, last
+        after = last
+
+
+class Command(BaseCommand):
+    help = 'Check Member balance/income counters against the IncomeHistory and WalletTransaction ledgers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Members per chunk (default: 5000)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Worker processes checking chunks in parallel (default: 1, in-process)'
+        )
+        parser.add_argument(
+            '--repair',
+            action='store_true',
+            help='Rewrite drifted counters with the ledger values'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size, workers, repair = options['chunk_size'], options['workers'], options['repair']
+        ranges = list(_member_ranges(chunk_size))  # ~200 tuples per million members
+
+        if workers > 1:
+            _close_inherited_connections()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_close_inherited_connections) as pool:
+                results = pool.map(reconcile_member_range, *zip(*ranges), [repair] * len(ranges))
+                drifted = self._report(results)
+        else:
+            drifted = self._report(reconcile_member_range(after, last, repair) for after, last in ranges)
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS(f'{len(ranges)} chunk(s) checked, no drift.'))
+        elif repair:
+            self.stdout.write(self.style.SUCCESS(f'{drifted} member(s) repaired.'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{drifted} member(s) drifted; re-run with --repair to fix.'))
+
+    def _report(self, results):
+        drifted = 0
+        for drift in results:
+            for member_id, diff in drift:
+                details = ', '.join(f'{field} {stored} != {ledger}' for field, (stored, ledger) in diff.items())
+                self.stdout.write(f'member {member_id}: {details}')
+            drifted += len(drift)
+        return drifted
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from mlm.services import run_binary_closing
+
+
+class Command(BaseCommand):
+    help = 'Pay matching income for all plans completed since the last binary closing'
+
+    def handle(self, *args, **options):
+        closing = run_binary_closing()
+        self.stdout.write(self.style.SUCCESS(
+            f'Closing #{closing.pk}: {closing.plans_processed} plans, {closing.members_credited} members, '
+            f'{closing.pairs} pairs, ₹{closing.amount}'
+        ))
@@ -0,0 +1,138 @@
+import random
+import threading
+import time
+from io import StringIO
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import CharField, F, Q, Value
+from django.db.models.functions import Cast, Concat
+from mlm.analytics import TreeArrays
+from mlm.models import Member, MemberClosure
+from mlm.services import place_many
+
+
+class Command(BaseCommand):
+    help = 'Register many members concurrently through the placement coordinator and verify the tree afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500, help='Registrations to place (default: 500)')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent registering threads (default: 8)')
+        parser.add_argument('--sponsors', type=int, default=5,
+                            help='Distinct sponsors the registrations share, lower = more contention (default: 5)')
+        parser.add_argument('--batch-size', type=int, default=1,
+                            help='Registrations per place_many call (default: 1)')
+        parser.add_argument('--prefix', default='stress', help='Username prefix (default: stress)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        User = get_user_model()
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f'Users named "{prefix}*" already exist; pick another --prefix.')
+
+        placed = list(Member.objects.filter(ancestor_links__depth=0).values_list('pk', flat=True)[:10000])
+        if not placed:
+            user = User(username=f'{prefix}-root', role=User.Role.MEMBER)
+            user.set_unusable_password()
+            user.save()
+            root = Member.objects.create(user=user)
+            MemberClosure.insert_node(root)
+            Member.objects.filter(pk=root.pk).update(left_tail=root, right_tail=root)
+            placed = [root.pk]
+        sponsors = rng.sample(placed, min(options['sponsors'], len(placed)))
+
+        users = []
+        for i in range(options['members']):
+            user = User(username=f'{prefix}{i}', role=User.Role.MEMBER)
+            user.set_unusable_password()
+            users.append(user)
+        new_members = Member.objects.bulk_create([Member(user=user) for user in User.objects.bulk_create(users)])
+        registrations = [
+            (Member(pk=rng.choice(sponsors)), member, rng.choice([None, Member.Position.LEFT, Member.Position.RIGHT]))
+            for member in new_members
+        ]
+
+        batch_size = options['batch_size']
+        errors, retries = [], [0]
+        lock = threading.Lock()
+
+        def register(share):
+            try:
+                for start in range(0, len(share), batch_size):
+                    batch = share[start:start + batch_size]
+                    for attempt in range(50):
+                        try:
+                            place_many(batch)
+                            break
+                        except OperationalError:
+                            # lock timeouts / "database is locked": back off and retry the batch
+                            with lock:
+                                retries[0] += 1
+                            time.sleep(0.01 * (attempt + 1))
+                    else:
+                        raise RuntimeError(f'batch starting at member {batch[0][1].pk} kept failing')
+            except Exception as exc:
+                with lock:
+                    errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=register, args=(registrations[i::options['threads']],))
+                   for i in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        problems = [f'registration failed: {exc!r}' for exc in errors] + self._check_tree([m.pk for m in new_members])
+        for problem in problems:
+            self.stdout.write(self.style.ERROR(problem))
+        if problems:
+            raise CommandError(f'Tree inconsistent after concurrent placement ({len(problems)} problem(s)).')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(new_members)} member(s) placed by {options["threads"]} thread(s) in {elapsed:.2f}s '
+            f'({retries[0]} retried batch(es)); tree consistent.'
+        ))
+
+    def _check_tree(self, new_ids):
+        problems = []
+        unplaced = Member.objects.filter(pk__in=new_ids, head_member__isnull=True).count()
+        if unplaced:
+            problems.append(f'{unplaced} registration(s) were not placed')
+
+        # every child is linked from its head on its own side, and no slot is shared
+        mislinked = Member.objects.exclude(head_member=None).exclude(
+            Q(position=Member.Position.LEFT, head_member__left=F('pk')) |
+            Q(position=Member.Position.RIGHT, head_member__right=F('pk'))
+        ).count()
+        if mislinked:
+            problems.append(f'{mislinked} member(s) are not linked from their head member')
+
+        stale_tails = Member.objects.filter(Q(left_tail__left__isnull=False) | Q(right_tail__right__isnull=False)).count()
+        if stale_tails:
+            problems.append(f'{stale_tails} member(s) have a leg tail pointer to an occupied slot')
+
+        stale_paths = Member.objects.exclude(head_member=None).exclude(
+            path=Concat('head_member__path', Cast('pk', output_field=CharField()), Value('/'))
+        ).count()
+        if stale_paths:
+            problems.append(f'{stale_paths} member(s) have a path that does not extend their head\'s path')
+
+        tree = TreeArrays.load()
+        nodes = np.searchsorted(tree.ids, np.array(sorted(new_ids), dtype=np.int64))
+        expected_rows = int((tree.depth()[nodes] + 1).sum())
+        closure_rows = MemberClosure.objects.filter(descendant_id__in=new_ids).count()
+        if closure_rows != expected_rows:
+            problems.append(f'{closure_rows} closure row(s) for the new members, expected {expected_rows}')
+
+        out = StringIO()
+        call_command('rebuild_tree_counters', dry_run=True, stdout=out)
+        if not out.getvalue().startswith('0 '):
+            problems.append(f'leg counters: {out.getvalue().strip()}')
+        return problems
@@ -3,21 +3,36 @@ from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
 from django.dispatch import receiver
-from decimal import Decimal
+from decimal import Decimal, ROUND_DOWN
 import logging
-from collections import deque
+import os
+import threading
 from django.core.exceptions import ValidationError
-from django.db.models import F
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Concat, Least, Substr
 
 logger = logging.getLogger(__name__)
 
+LEVEL_CACHE_KEY = 'mlm:plan-levels:{plan_id}'
+REFERRAL_CACHE_KEY = 'mlm:referral-generations:{member_id}'
+
 
 # ---------------------------
 # Company wallet (singleton-like usage)
 # ---------------------------
 class CompanyWallet(models.Model):
+    """
+    The funds live in CompanyWalletShard rows; balance is only the reserve not spread to
+    the shards yet (legacy balance, manual top-ups), so concurrent credits and debits
+    touch one shard row each and never queue on this row. A debit can never overdraw:
+    it is a guarded UPDATE of a single shard (see deduct_from_wallet).
+    Read the live figure with get_balance().
+    """
+    SHARDS = 8
+
     balance = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
     charges_balance = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
 
@@ -28,23 +43,107 @@ class CompanyWallet(models.Model):
     def __str__(self):
         return f"Company Wallet: ₹{self.balance}"
 
+    def get_balance(self):
+        """Reserve plus every shard (one query)."""
+        base, pending = (
+            CompanyWallet.objects.filter(pk=self.pk)
+            .annotate(pending=Sum('shards__balance'))
+            .values_list('balance', 'pending')
+            .get()
+        )
+        return base + (pending or Decimal('0.00'))
+
+    def create_shards(self):
+        CompanyWalletShard.objects.bulk_create(
+            [CompanyWalletShard(wallet=self, shard_no=shard_no) for shard_no in range(self.SHARDS)],
+            ignore_conflicts=True,
+        )
+
+    def _home_shard(self):
+        """
+        Shard this worker thread uses first: concurrent workers spread over the shards,
+        and one transaction's credits and debits normally lock a single shard row.
+        """
+        return hash((os.getpid(), threading.get_ident())) % self.SHARDS
+
+    def _apply_to_shard(self, delta):
+        """Atomically add delta to the home shard row."""
+        shards = CompanyWalletShard.objects.filter(wallet=self, shard_no=self._home_shard())
+        if not shards.update(balance=F('balance') + delta):
+            # wallet created before sharding existed
+            self.create_shards()
+            shards.update(balance=F('balance') + delta)
+
     def add_to_wallet(self, amount):
         amount = Decimal(amount)
         if amount < 0:
             raise ValueError("Amount to add cannot be negative.")
-        self.balance += amount
-        self.save(update_fields=['balance'])
-        return self.balance
+        self._apply_to_shard(amount)
+        return self.get_balance()
 
     def deduct_from_wallet(self, amount):
+        """
+        Debit amount, or raise ValueError when the wallet cannot cover it. Payout callers
+        let the error roll their credits back, so nothing is paid that the wallet does not
+        hold. Fast path: UPDATE ... WHERE balance >= amount on the home shard, then on the
+        richest shard; only when no single shard can cover it are all shards locked, the
+        debit taken from the total and the rest spread evenly again (compact).
+        """
         amount = Decimal(amount)
         if amount < 0:
             raise ValueError("Amount to deduct cannot be negative.")
-        if amount > self.balance:
+        if amount == 0:
+            return
+        covering = CompanyWalletShard.objects.filter(wallet=self, balance__gte=amount)
+        if covering.filter(shard_no=self._home_shard()).update(balance=F('balance') - amount):
+            return
+        richest = covering.order_by('-balance').values_list('shard_no', flat=True).first()
+        if richest is not None and covering.filter(shard_no=richest).update(balance=F('balance') - amount):
+            return
+        self.compact(debit=amount)
+
+    @transaction.atomic
+    def compact(self, debit=Decimal('0.00')):
+        """
+        Rebalance: lock every shard (in shard order) and the wallet row, take `debit` out
+        of the total (ValueError if it does not cover it) and spread the rest evenly over
+        the shards, emptying the reserve. Returns the remaining balance.
+        """
+        self.create_shards()
+        shards = list(CompanyWalletShard.objects.select_for_update().filter(wallet=self).order_by('shard_no'))
+        reserve = CompanyWallet.objects.select_for_update().values_list('balance', flat=True).get(pk=self.pk)
+        total = reserve + sum((shard.balance for shard in shards), Decimal('0.00')) - debit
+        if total < 0:
             raise ValueError("Insufficient balance in the wallet.")
-        self.balance -= amount
-        self.save(update_fields=['balance'])
-        return self.balance
+        share = (total / len(shards)).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+        for shard in shards:
+            shard.balance = share
+        shards[-1].balance = total - share * (len(shards) - 1)
+        CompanyWalletShard.objects.bulk_update(shards, ['balance'])
+        CompanyWallet.objects.filter(pk=self.pk).update(balance=Decimal('0.00'))
+        self.balance = Decimal('0.00')
+        return total
+
+
+class CompanyWalletShard(models.Model):
+    """One slice of the company funds (never negative; see CompanyWallet.deduct_from_wallet)."""
+    wallet = models.ForeignKey(CompanyWallet, on_delete=models.CASCADE, related_name='shards')
+    shard_no = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        verbose_name = "Company Wallet Shard"
+        verbose_name_plural = "Company Wallet Shards"
+        unique_together = ('wallet', 'shard_no')
+
+    def __str__(self):
+        return f"Wallet {self.wallet_id} shard {self.shard_no}: ₹{self.balance}"
+
+
+@receiver(post_save, sender=CompanyWallet)
+def create_company_wallet_shards(sender, instance, created, **kwargs):
+    if created:
+        instance.create_shards()
 
 
 # ---------------------------
@@ -63,6 +162,8 @@ class Plan(models.Model):
     # direct and matching stored as absolute amounts (₹)
     direct = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
     matching = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    # most matching pairs paid per member per day (blank = unlimited); the rest are flushed
+    daily_pair_cap = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.name} - ₹{self.price}"
@@ -89,6 +190,31 @@ class Level(models.Model):
     def __str__(self):
         return f"{self.plan.name} | Level {self.level} -> ₹{self.distributed_amount} | Resale {self.resale_percentage}%"
 
+    @classmethod
+    def for_plan(cls, plan_id):
+        """
+        Return {level: (distributed_amount, resale_percentage)} for a plan.
+        Cached until a Level or Plan row is saved/deleted (see invalidate_level_cache), and at
+        most MLM_LEVEL_CACHE_TTL seconds so processes without a shared cache converge too.
+        """
+        key = LEVEL_CACHE_KEY.format(plan_id=plan_id)
+        levels = cache.get(key)
+        if levels is None:
+            levels = {
+                level: (distributed_amount, resale_percentage)
+                for level, distributed_amount, resale_percentage in cls.objects.filter(plan_id=plan_id)
+                .values_list('level', 'distributed_amount', 'resale_percentage')
+            }
+            cache.set(key, levels, getattr(settings, 'MLM_LEVEL_CACHE_TTL', 60))
+        return levels
+
+
+@receiver([post_save, post_delete], sender=Level)
+@receiver([post_save, post_delete], sender=Plan)
+def invalidate_level_cache(sender, instance, **kwargs):
+    plan_id = instance.plan_id if sender is Level else instance.pk
+    cache.delete(LEVEL_CACHE_KEY.format(plan_id=plan_id))
+
 
 class RankAndRewards(models.Model):
     """
@@ -101,6 +227,8 @@ class RankAndRewards(models.Model):
     pairs = models.PositiveIntegerField(default=0)
     amount = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
     reward_name = models.CharField(max_length=150, null=True, blank=True)
+    # daily pair cap for members holding this rank; overrides the plan cap when set
+    daily_pair_cap = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['rank_no']
@@ -135,15 +263,33 @@ class Member(models.Model):
     left = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='left_user' )
     right = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='right_user' )
 
+    # outermost vacant node of each leg (end of the all-left / all-right chain), for O(1) placement
+    left_tail = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='+' )
+    right_tail = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='+' )
+
     # subtree counters
     left_count = models.PositiveIntegerField(default=0)
     right_count = models.PositiveIntegerField(default=0)
+    left_active_count = models.PositiveIntegerField(default=0)
+    right_active_count = models.PositiveIntegerField(default=0)
+
+    # business volume (plan price) bought per leg: unmatched carry-forward and lifetime totals
+    left_bv = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    right_bv = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    total_left_bv = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    total_right_bv = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
+    # materialized placement path: ancestor ids root first, self last ("1/5/9/"), and depth below the root
+    path = models.TextField(blank=True, default='')
+    depth = models.PositiveIntegerField(default=0)
 
     # levels/rank/matching
     level = models.PositiveIntegerField(default=0)
     rank_no = models.PositiveIntegerField(default=0)
     matching_pairs = models.PositiveIntegerField(default=0)
     all_matching_pairs = models.PositiveIntegerField(default=0)
+    # pairs paid since midnight (checked against the daily cap; reset by reset_daily_counters)
+    today_pairs = models.PositiveIntegerField(default=0)
 
     # incomes & balances
     account_balance = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
@@ -172,6 +318,11 @@ class Member(models.Model):
             models.Index(fields=['status']),
             models.Index(fields=['sponsor']),
             models.Index(fields=['head_member']),
+            models.Index(fields=['status', '-total_income'], name='mlm_member_status_income_idx'),
+            # expression indexes for the binary closing: unpaid pairs and matchable leg volume
+            models.Index(Least('left_active_count', 'right_active_count') - F('all_matching_pairs'),
+                         name='mlm_member_unpaid_pairs_idx'),
+            models.Index(Least('left_bv', 'right_bv'), name='mlm_member_matchable_bv_idx'),
         ]
 
     def __str__(self):
@@ -182,12 +333,41 @@ class Member(models.Model):
     # Utility methods (Updated)
     # ---------------------------
 
+    @transaction.atomic
     def activate(self):
-        """Activate this member safely."""
+        """Activate this member safely and count it in every ancestor's active leg counter."""
         if self.status == self.Status.ACTIVE:
             return  # already active, avoid redundant save
+        # conditional flip so concurrent calls only propagate once
+        if Member.objects.filter(pk=self.pk).exclude(status=self.Status.ACTIVE).update(status=self.Status.ACTIVE):
+            MemberClosure.add_to_ancestors(self, 'left_active_count', 'right_active_count', 1)
         self.status = self.Status.ACTIVE
-        self.save(update_fields=['status'])
+
+    @classmethod
+    @transaction.atomic
+    def activate_many(cls, member_ids):
+        """Set-based activate() for many members at once (fixed number of queries)."""
+        inactive = cls.objects.filter(pk__in=member_ids).exclude(status=cls.Status.ACTIVE)
+        newly_active = list(inactive.select_for_update().values_list('pk', flat=True))
+        if newly_active:
+            cls.objects.filter(pk__in=newly_active).update(status=cls.Status.ACTIVE)
+            MemberClosure.add_to_ancestors_of_many(newly_active, 'left_active_count', 'right_active_count')
+        return newly_active
+
+    @transaction.atomic
+    def deactivate(self):
+        """Reverse of activate()."""
+        if self.status == self.Status.INACTIVE:
+            return
+        if Member.objects.filter(pk=self.pk, status=self.Status.ACTIVE).update(status=self.Status.INACTIVE):
+            MemberClosure.add_to_ancestors(self, 'left_active_count', 'right_active_count', -1)
+        self.status = self.Status.INACTIVE
+
+    def update_rank_if_needed(self):
+        """Promote to the highest rank whose pair requirement is met (see services.recompute_ranks)."""
+        from mlm.services import recompute_ranks
+        if recompute_ranks([self.pk]):
+            self.refresh_from_db(fields=['rank_no'])
 
     def get_direct_team(self):
         """
@@ -196,42 +376,122 @@ class Member(models.Model):
         """
         return Member.objects.filter(sponsor=self)
 
+    def get_referral_generations(self):
+        """
+        Members and active members per referral generation below self (1 = direct referrals),
+        from one grouped query on SponsorClosure. Cached per member; new referrals drop the
+        cache, activations show up within MLM_REFERRAL_REPORT_TTL seconds.
+        """
+        key = REFERRAL_CACHE_KEY.format(member_id=self.pk)
+        generations = cache.get(key)
+        if generations is None:
+            rows = (SponsorClosure.objects.filter(ancestor=self, depth__gte=1).values('depth')
+                    .annotate(members=Count('pk'), active=Count('pk', filter=Q(descendant__status=Member.Status.ACTIVE)))
+                    .order_by('depth'))
+            generations = [{'generation': row['depth'], 'members': row['members'], 'active': row['active']}
+                           for row in rows]
+            cache.set(key, generations, getattr(settings, 'MLM_REFERRAL_REPORT_TTL', 300))
+        return generations
+
+    def get_downline(self, position=None, max_depth=None):
+        """
+        Return a queryset of members below self in the placement tree.
+        Backed by MemberClosure, so any leg / depth slice is a single indexed query.
+        - position: LEFT/RIGHT to restrict to one leg, None for the full subtree.
+        - max_depth: only include members at most this many levels below self.
+        """
+        filters = {'ancestor_links__ancestor': self, 'ancestor_links__depth__gte': 1}
+        if position:
+            filters['ancestor_links__leg'] = position
+        if max_depth is not None:
+            filters['ancestor_links__depth__lte'] = max_depth
+        return Member.objects.filter(**filters).order_by('ancestor_links__depth', 'pk')
+
     def get_left_team(self):
         """
-        Get all members in the left subtree using BFS.
+        Get all members in the left subtree (level by level).
         """
-        team = []
-        if self.left:
-            queue = deque([self.left])
-            while queue:
-                member = queue.popleft()
-                team.append(member)
-                if member.left:
-                    queue.append(member.left)
-                if member.right:
-                    queue.append(member.right)
-        return team
+        return list(self.get_downline(Member.Position.LEFT))
 
     def get_right_team(self):
         """
-        Get all members in the right subtree using BFS.
+        Get all members in the right subtree (level by level).
+        """
+        return list(self.get_downline(Member.Position.RIGHT))
+
+    def get_path(self):
+        """Materialized path of self; built from the uplines (see get_uplines) for members placed before paths existed."""
+        if self.path:
+            return self.path
+        ids = [upline.pk for upline in reversed(self.get_uplines())] + [self.pk]
+        return ''.join(f'{pk}/' for pk in ids)
+
+    def get_upline_ids(self, max_depth=None):
+        """Placement ancestor ids, nearest first. Parsed from the path (no query) when it is set."""
+        if not self.path:
+            return [upline.pk for upline in self.get_uplines(max_depth)]
+        ids = [int(pk) for pk in self.path.split('/')[-3::-1]]
+        return ids if max_depth is None else ids[:max_depth]
+
+    def is_in_downline_of(self, other):
+        """True if self sits anywhere below `other` (prefix match on the paths, closure lookup otherwise)."""
+        if self.path and other.path:
+            return self.pk != other.pk and self.path.startswith(other.path)
+        return MemberClosure.objects.filter(ancestor=other, descendant=self, depth__gte=1).exists()
+
+    def get_uplines(self, max_depth=None):
+        """
+        Return the placement ancestors of self, nearest first (index 0 = head_member).
+        One pk lookup of the ids on the materialized path, else one indexed query on
+        MemberClosure; walks head_member only for trees that were never indexed (run
+        `rebuild_tree_paths` / `rebuild_tree_index` to backfill them).
+        """
+        if self.path:
+            ids = self.get_upline_ids(max_depth)
+            uplines = Member.objects.select_related('user').in_bulk(ids)
+            return [uplines[pk] for pk in ids if pk in uplines]
+
+        filters = {'descendant_links__descendant': self, 'descendant_links__depth__gte': 1}
+        if max_depth is not None:
+            filters['descendant_links__depth__lte'] = max_depth
+        uplines = list(Member.objects.filter(**filters).select_related('user').order_by('descendant_links__depth'))
+        if uplines or not self.head_member_id:
+            return uplines
+
+        current = self.head_member
+        while current and (max_depth is None or len(uplines) < max_depth):
+            uplines.append(current)
+            current = current.head_member
+        return uplines
+
+    def rewrite_subtree_paths(self, head_path):
+        """
+        After self (with its subtree) moved under the member whose path is `head_path`, re-root
+        every path in the subtree with one set-based UPDATE over self's closure rows.
         """
-        team = []
-        if self.right:
-            queue = deque([self.right])
-            while queue:
-                member = queue.popleft()
-                team.append(member)
-                if member.left:
-                    queue.append(member.left)
-                if member.right:
-                    queue.append(member.right)
-        return team
+        old_prefix = self.get_path()
+        new_prefix = f'{head_path}{self.pk}/'
+        Member.objects.filter(ancestor_links__ancestor=self).exclude(path='').update(
+            path=Concat(Value(new_prefix), Substr('path', len(old_prefix) + 1), output_field=models.TextField()),
+            depth=F('depth') + (new_prefix.count('/') - old_prefix.count('/')),
+        )
 
     def get_team_sizes(self):
         """Return cached counters instantly (O(1))."""
         return self.left_count, self.right_count
 
+    def get_income_summary(self):
+        """Today / this month / lifetime-by-type income from the daily rollups (indexed lookups, no ledger scan)."""
+        today = timezone.localdate()
+        rollups = IncomeDailyRollup.objects.filter(member=self)
+        month = rollups.filter(date__gte=today.replace(day=1), date__lte=today).aggregate(
+            today=Sum('amount', filter=Q(date=today)), this_month=Sum('amount'))
+        by_type = dict(rollups.values('income_type').annotate(total=Sum('amount')).values_list('income_type', 'total'))
+        return {
+            'today': month['today'] or Decimal('0.00'),
+            'this_month': month['this_month'] or Decimal('0.00'),
+            'by_type': by_type,
+        }
 
     # ---------------------------------------
     # 🔑 Placement Finder
@@ -240,7 +500,7 @@ class Member(models.Model):
         """
         Sponsor-based placement finder.
         Rules:
-        1. If position is given (LEFT/RIGHT), strictly place in that branch using BFS.
+        1. If position is given (LEFT/RIGHT), strictly place at the outermost end of that branch.
         2. If position is not given → choose smaller side (if equal → choose LEFT).
         3. Return (head_member, final_position).
         """
@@ -255,38 +515,30 @@ class Member(models.Model):
             else:
                 preferred_side = Member.Position.RIGHT
 
-        # Step 2: BFS traversal in chosen side
-        queue = deque()
+        # Step 2: Jump straight to the outermost vacant node of that side
+        return self.get_leg_tail(preferred_side), preferred_side
 
-        if preferred_side == Member.Position.LEFT:
-            if not self.left:
-                return self, Member.Position.LEFT
-            queue.append(self.left)
-            side = Member.Position.LEFT
-        else:
-            if not self.right:
-                return self, Member.Position.RIGHT
-            queue.append(self.right)
-            side = Member.Position.RIGHT
-
-        while queue:
-            current = queue.popleft()
-
-            # Check if current node has empty slot
-            if side == Member.Position.LEFT and not current.left:
-                return current, Member.Position.LEFT
-            elif side == Member.Position.RIGHT and not current.right:
-                return current, Member.Position.RIGHT
-
-            # Continue BFS deeper into same side
-            if side == Member.Position.LEFT:
-                if current.left:
-                    queue.append(current.left)
-            else:
-                if current.right:
-                    queue.append(current.right)
-
-        raise ValidationError("No placement found (tree side unexpectedly full).")
+    def get_leg_tail(self, side):
+        """
+        Return the outermost vacant node of the given side, i.e. the end of the
+        all-left (or all-right) chain below self. Uses the maintained left_tail /
+        right_tail pointer (1 query); walks the chain and repairs the pointer only
+        when it is missing or stale (trees created before the pointers existed).
+        """
+        slot = 'left' if side == Member.Position.LEFT else 'right'
+        tail_field = f'{slot}_tail'
+        tail_id = getattr(self, f'{tail_field}_id')
+        if tail_id:
+            tail = self if tail_id == self.pk else Member.objects.filter(pk=tail_id).first()
+            if tail is not None and not getattr(tail, f'{slot}_id'):
+                return tail
+
+        current = self
+        while getattr(current, f'{slot}_id'):
+            current = getattr(current, slot)
+        Member.objects.filter(pk=self.pk).update(**{tail_field: current})
+        setattr(self, tail_field, current)
+        return current
 
     # ---------------------------------------
     # 🔑 Assign New Member
@@ -299,6 +551,8 @@ class Member(models.Model):
         - Sponsor = always the referrer (self) OR root if first placement.
         - Head = jiske niche actually lagaya gaya (find_placement).
         - Position = LEFT/RIGHT auto decided (balance) if not given.
+        Concurrent registrations should go through mlm.services.place_member / place_many,
+        which lock every row touched here in one ordered statement first.
         """
 
         if new_member == self:
@@ -314,7 +568,13 @@ class Member(models.Model):
             new_member.head_member = None
             new_member.sponsor = None
             new_member.position = None
-            new_member.save(update_fields=['head_member', 'sponsor', 'position'])
+            new_member.left_tail = new_member
+            new_member.right_tail = new_member
+            new_member.path = f'{new_member.pk}/'
+            new_member.depth = 0
+            new_member.save(update_fields=['head_member', 'sponsor', 'position', 'left_tail', 'right_tail', 'path', 'depth'])
+            MemberClosure.insert_node(new_member)
+            SponsorClosure.insert_node(new_member)
             return new_member, None
 
         # Step 3: Find placement head under sponsor
@@ -333,7 +593,15 @@ class Member(models.Model):
         new_member.sponsor = sponsor_locked
         new_member.head_member = head_locked
         new_member.position = final_position
-        new_member.save(update_fields=['sponsor', 'head_member', 'position'])
+        new_member.left_tail = new_member
+        new_member.right_tail = new_member
+        head_path = head_locked.get_path()
+        if not head_locked.path:
+            head_locked.path, head_locked.depth = head_path, head_path.count('/') - 1
+            head_locked.save(update_fields=['path', 'depth'])
+        new_member.path = f'{head_path}{new_member.pk}/'
+        new_member.depth = head_locked.depth + 1
+        new_member.save(update_fields=['sponsor', 'head_member', 'position', 'left_tail', 'right_tail', 'path', 'depth'])
 
         # Step 7: Attach into tree
         if final_position == Member.Position.LEFT:
@@ -341,19 +609,165 @@ class Member(models.Model):
         else:
             head_locked.right = new_member
         head_locked.save(update_fields=['left', 'right'])
+        MemberClosure.insert_node(new_member, head_locked, final_position)
+        SponsorClosure.insert_node(new_member, sponsor_locked)
 
-        # Step 8: Update counts up the ancestor chain
-        current, child = head_locked, new_member
-        while current:
-            if current.left_id == child.id:
-                Member.objects.filter(pk=current.pk).update(left_count=F('left_count') + 1)
-            elif current.right_id == child.id:
-                Member.objects.filter(pk=current.pk).update(right_count=F('right_count') + 1)
-            child, current = current, current.head_member
+        # Step 7b: Every member whose outer chain ended at head now ends at new_member
+        tail_field = 'left_tail' if final_position == Member.Position.LEFT else 'right_tail'
+        Member.objects.filter(Q(**{tail_field: head_locked}) | Q(pk=head_locked.pk)).update(**{tail_field: new_member})
+
+        # Step 8: Update counts up the ancestor chain (one set-based UPDATE per leg)
+        MemberClosure.add_to_ancestors(new_member, 'left_count', 'right_count', 1)
 
         return head_locked, final_position
 
 
+# ---------------------------
+# Placement tree index (closure table)
+# ---------------------------
+class MemberClosure(models.Model):
+    """
+    One row per (ancestor, descendant) pair of the binary placement tree, including
+    the depth-0 self row. leg records which side of the ancestor the descendant sits
+    on, so left/right teams and depth-bounded slices come back from one indexed query.
+    Rows are written by Member.assign_new_member; use `rebuild_tree_index` to backfill.
+    """
+    ancestor = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField(default=0)
+    leg = models.CharField(max_length=10, choices=Member.Position.choices, null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Member Closure"
+        verbose_name_plural = "Member Closures"
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['ancestor', 'leg', 'depth']),
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.leg or 'self'}, depth {self.depth})"
+
+    @classmethod
+    def insert_node(cls, member, head=None, position=None):
+        """
+        Link a freshly placed leaf `member` under `head` on `position`.
+        Copies head's ancestor rows one level deeper (2 queries regardless of depth).
+        A head without any rows (a root created as a plain profile, or a tree placed before
+        the index existed) is indexed on the fly from its path / head_member chain, so the
+        new rows and the counter updates that follow them still reach every ancestor.
+        """
+        links = [cls(ancestor_id=member.pk, descendant_id=member.pk, depth=0, leg=None)]
+        if head is not None:
+            for ancestor_id, depth, leg in cls.index_chain(head):
+                links.append(cls(ancestor_id=ancestor_id, descendant_id=member.pk,
+                                 depth=depth + 1, leg=leg or position))
+        cls.objects.bulk_create(links, ignore_conflicts=True)
+
+    @classmethod
+    def index_chain(cls, member):
+        """
+        Return member's rows as [(ancestor_id, depth, leg)], self row included (1 query).
+        A member without rows is indexed on the fly from its path / head_member chain.
+        """
+        links = list(cls.objects.filter(descendant_id=member.pk).values_list('ancestor_id', 'depth', 'leg'))
+        if not links:
+            chain = [member] + member.get_uplines()
+            # each ancestor sees member on the side of its chain child
+            links = [(member.pk, 0, None)] + [(chain[k].pk, k, chain[k - 1].position) for k in range(1, len(chain))]
+            cls.objects.bulk_create([cls(ancestor_id=ancestor_id, descendant_id=member.pk, depth=depth, leg=leg)
+                                     for ancestor_id, depth, leg in links], ignore_conflicts=True)
+        return links
+
+    @classmethod
+    def add_to_ancestors(cls, member, left_field, right_field, amount):
+        """
+        Add `amount` to left_field on every ancestor that has `member` in its left leg
+        and to right_field on every ancestor that has it in its right leg.
+        Two UPDATE statements whatever the depth of the tree.
+        """
+        for leg, field in ((Member.Position.LEFT, left_field), (Member.Position.RIGHT, right_field)):
+            ancestor_ids = cls.objects.filter(descendant_id=member.pk, depth__gte=1, leg=leg).values('ancestor_id')
+            Member.objects.filter(pk__in=ancestor_ids).update(**{field: F(field) + amount})
+
+    @classmethod
+    def add_to_ancestors_of_many(cls, member_ids, left_field, right_field):
+        """
+        add_to_ancestors(member, ..., 1) for many members at once: each ancestor's
+        counter grows by the number of given members in that leg. Two UPDATEs in total.
+        """
+        for leg, field in ((Member.Position.LEFT, left_field), (Member.Position.RIGHT, right_field)):
+            links = cls.objects.filter(descendant_id__in=member_ids, depth__gte=1, leg=leg)
+            per_ancestor = (links.filter(ancestor_id=OuterRef('pk')).order_by()
+                            .values('ancestor_id').annotate(n=Count('pk')).values('n'))
+            Member.objects.filter(pk__in=links.values('ancestor_id')).update(**{field: F(field) + Subquery(per_ancestor)})
+
+    @classmethod
+    def add_plan_volume(cls, member_plan_ids):
+        """
+        Roll the business volume (plan price) of the given MemberPlans up the tree: every
+        ancestor's carry-forward and lifetime BV of a leg grow by the volume bought in that
+        leg. Two UPDATEs in total, whatever the number of purchases or the depth.
+        """
+        for leg, carry, total in ((Member.Position.LEFT, 'left_bv', 'total_left_bv'),
+                                  (Member.Position.RIGHT, 'right_bv', 'total_right_bv')):
+            links = cls.objects.filter(descendant__plans__in=member_plan_ids, depth__gte=1, leg=leg)
+            volume = Subquery(
+                MemberPlan.objects.filter(pk__in=member_plan_ids, member__ancestor_links__ancestor_id=OuterRef('pk'),
+                                          member__ancestor_links__leg=leg, member__ancestor_links__depth__gte=1)
+                .order_by().values('member__ancestor_links__ancestor_id').annotate(volume=Sum('plan__price'))
+                .values('volume')
+            )
+            Member.objects.filter(pk__in=links.values('ancestor_id')).update(
+                **{carry: F(carry) + volume, total: F(total) + volume}
+            )
+
+
+# ---------------------------
+# Sponsor tree index (closure table)
+# ---------------------------
+class SponsorClosure(models.Model):
+    """
+    One row per (ancestor, descendant) pair of the sponsor (referral) tree, including the
+    depth-0 self row; depth is the referral generation. Separate from the placement tree.
+    Rows are written by Member.assign_new_member; use `rebuild_sponsor_index` to backfill.
+    """
+    ancestor = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='referral_links')
+    descendant = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='sponsor_links')
+    depth = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Sponsor Closure"
+        verbose_name_plural = "Sponsor Closures"
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['ancestor', 'depth']),
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} (generation {self.depth})"
+
+    @classmethod
+    def insert_node(cls, member, sponsor=None):
+        """
+        Index a newly sponsored `member` below `sponsor` by copying the sponsor's rows one
+        generation deeper (2 queries), and drop the cached referral reports of every upline.
+        """
+        links = [cls(ancestor_id=member.pk, descendant_id=member.pk, depth=0)]
+        if sponsor is not None:
+            sponsor_links = list(cls.objects.filter(descendant_id=sponsor.pk).values_list('ancestor_id', 'depth'))
+            if not sponsor_links:
+                # sponsor was never indexed (root of the referral tree)
+                links.append(cls(ancestor_id=sponsor.pk, descendant_id=sponsor.pk, depth=0))
+                sponsor_links = [(sponsor.pk, 0)]
+            for ancestor_id, depth in sponsor_links:
+                links.append(cls(ancestor_id=ancestor_id, descendant_id=member.pk, depth=depth + 1))
+            cache.delete_many([REFERRAL_CACHE_KEY.format(member_id=ancestor_id) for ancestor_id, _ in sponsor_links])
+        cls.objects.bulk_create(links, ignore_conflicts=True)
+
+
 # ---------------------------
 # Bank details for members
 # ---------------------------
@@ -389,11 +803,17 @@ class MemberPlan(models.Model):
     plan = models.ForeignKey(Plan, on_delete=models.PROTECT)
     purchased_date = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=10, choices=PURCHASE_STATUS_CHOICES, default=STATUS_PENDING)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    closing = models.ForeignKey('BinaryClosing', on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='plans')
 
     class Meta:
         verbose_name = "Member Plan"
         verbose_name_plural = "Member Plans"
         ordering = ['-purchased_date']
+        indexes = [
+            models.Index(fields=['status', 'completed_at']),
+        ]
 
     def __str__(self):
         return f"{self.member.user.username} - {self.plan.name}"
@@ -403,18 +823,64 @@ class MemberPlan(models.Model):
         Mark purchase completed and trigger commission processing.
         Commission allocation logic should be implemented in a service function (see update_matching_income below).
         """
-        if self.status == self.STATUS_COMPLETED:
-            return
-        self.status = self.STATUS_COMPLETED
-        self.save(update_fields=['status'])
-        # trigger commission distribution (call external task/service)
+        with transaction.atomic():
+            # conditional switch: of two concurrent or repeated calls only one changes the row,
+            # so activation and the volume roll-up below run once per purchase
+            now = timezone.now()
+            switched = (MemberPlan.objects.filter(pk=self.pk).exclude(status=self.STATUS_COMPLETED)
+                        .update(status=self.STATUS_COMPLETED, completed_at=now))
+            if not switched:
+                self.refresh_from_db(fields=['status', 'completed_at'])
+                return
+            self.status, self.completed_at = self.STATUS_COMPLETED, now
+            # a completed purchase makes the buyer an active member (feeds matching counters)
+            self.member.activate()
+            MemberClosure.add_plan_volume([self.pk])
+        # trigger commission distribution (queued as an idempotent CommissionJob)
         try:
-            from mlm.services import process_commissions_for_purchase
-            process_commissions_for_purchase(self)
+            from mlm.services import enqueue_commissions
+            return enqueue_commissions(self)
         except Exception:
             logger.exception("Failed to trigger commission processing for MemberPlan id=%s", self.pk)
 
 
+class CommissionJob(models.Model):
+    """
+    Idempotency record for the commissions of one MemberPlan.
+    The credits and the switch to DONE are committed in the same transaction,
+    so a job is paid at most once however often it is retried.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    member_plan = models.OneToOneField(MemberPlan, on_delete=models.CASCADE, related_name='commission_job')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Commission Job"
+        verbose_name_plural = "Commission Jobs"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status']),
+        ]
+
+    def __str__(self):
+        return f"Commissions for MemberPlan {self.member_plan_id} ({self.status})"
+
+
 # ---------------------------
 # Income history, wallet & payment models
 # ---------------------------
@@ -450,6 +916,61 @@ class IncomeHistory(models.Model):
         return f"{self.member.user.username} - {self.income_type} - ₹{self.amount}"
 
 
+class IncomeDailyRollup(models.Model):
+    """
+    Per member, per day, per income type totals of IncomeHistory, maintained by whatever
+    writes the history rows (see add_many) so dashboards read a handful of rows, not the ledger.
+    """
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='income_rollups')
+    date = models.DateField()
+    income_type = models.CharField(max_length=30, choices=IncomeHistory.INCOME_TYPE_CHOICES)
+    amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Income Daily Rollup"
+        verbose_name_plural = "Income Daily Rollups"
+        ordering = ['-date']
+        unique_together = ('member', 'date', 'income_type')
+
+    def __str__(self):
+        return f"{self.member_id} - {self.date} - {self.income_type} - ₹{self.amount}"
+
+    @classmethod
+    def add_many(cls, histories, date=None):
+        """
+        Fold IncomeHistory objects into the rollups with a fixed two queries: an insert of
+        the missing keys (ignore_conflicts) and one CASE UPDATE adding the deltas.
+        """
+        date = date or timezone.localdate()
+        totals = {}
+        for history in histories:
+            key = (history.member_id, history.income_type)
+            amount, count = totals.get(key, (Decimal('0.00'), 0))
+            totals[key] = (amount + history.amount, count + 1)
+        if not totals:
+            return
+
+        # make sure every key has a row, then add all deltas with one CASE UPDATE
+        cls.objects.bulk_create([
+            cls(member_id=member_id, date=date, income_type=income_type)
+            for member_id, income_type in totals
+        ], ignore_conflicts=True)
+        amount_whens, count_whens = [], []
+        for (member_id, income_type), (amount, count) in totals.items():
+            amount_whens.append(When(member_id=member_id, income_type=income_type, then=Value(amount)))
+            count_whens.append(When(member_id=member_id, income_type=income_type, then=Value(count)))
+        cls.objects.filter(
+            date=date,
+            member_id__in={member_id for member_id, _ in totals},
+            income_type__in={income_type for _, income_type in totals},
+        ).update(
+            amount=F('amount') + Case(*amount_whens, default=Value(Decimal('0.00')),
+                                      output_field=models.DecimalField(max_digits=18, decimal_places=2)),
+            count=F('count') + Case(*count_whens, default=Value(0), output_field=models.IntegerField()),
+        )
+
+
 class WalletTransaction(models.Model):
     TRANSACTION_CREDIT = 'credit'
     TRANSACTION_DEBIT = 'debit'
@@ -569,91 +1090,155 @@ class PaymentRequest(models.Model):
                 super().save(update_fields=['status', 'completed_date', 'admin_notes'])
 
 
+class BinaryClosing(models.Model):
+    """
+    One run of the batch matching ("binary closing") engine.
+    Covers the completed MemberPlans it claimed (MemberPlan.closing); plans committed
+    after a closing read its window are claimed by the next one.
+    """
+    period_start = models.DateTimeField(null=True, blank=True)
+    period_end = models.DateTimeField()
+    plans_processed = models.PositiveIntegerField(default=0)
+    members_credited = models.PositiveIntegerField(default=0)
+    pairs = models.PositiveIntegerField(default=0)
+    pairs_flushed = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    volume_matched = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Binary Closing"
+        verbose_name_plural = "Binary Closings"
+        ordering = ['-period_end']
+
+    def __str__(self):
+        return f"Closing up to {self.period_end:%Y-%m-%d %H:%M} - {self.pairs} pair(s), ₹{self.amount}"
+
+
+class FlushedPairs(models.Model):
+    """
+    Audit trail of matching pairs consumed without payout because the member had
+    reached the daily pair cap. Written in bulk by the matching engines.
+    """
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, related_name='flushed_pairs')
+    closing = models.ForeignKey(BinaryClosing, on_delete=models.SET_NULL, null=True, blank=True, related_name='flushed_pairs')
+    date = models.DateField(default=timezone.localdate)
+    pairs = models.PositiveIntegerField()
+    daily_cap = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Flushed Pairs"
+        verbose_name_plural = "Flushed Pairs"
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['member', 'date'])]
+
+    def __str__(self):
+        return f"{self.member_id} - {self.date} - {self.pairs} pair(s) flushed"
+
+
 # ---------------------------
 # Helper service: matching update
 # ---------------------------
+def get_matching_rates(member_ids):
+    """
+    Return {member_id: per-pair matching amount} from each member's own plan
+    (the plan `member.plans.last()` resolves to), in one query.
+    Members without any plan are missing from the result.
+    """
+    matching_rates = {}
+    rows = (MemberPlan.objects.filter(member_id__in=member_ids)
+            .order_by('-purchased_date').values_list('member_id', 'plan__matching'))
+    for member_id, matching in rows:
+        matching_rates[member_id] = matching
+    return matching_rates
+
+
+def get_daily_pair_caps(members):
+    """
+    Return {member_id: daily pair cap} for the given Member instances, in one query:
+    the cap of the member's rank when it sets one, else the cap of the member's own plan
+    (resolved like get_matching_rates). Uncapped members are missing from the result.
+    """
+    rank_caps = dict(RankAndRewards.objects.filter(daily_pair_cap__isnull=False).values_list('rank_no', 'daily_pair_cap'))
+    caps = {}
+    rows = (MemberPlan.objects.filter(member_id__in=[m.pk for m in members])
+            .order_by('-purchased_date').values_list('member_id', 'plan__daily_pair_cap'))
+    for member_id, cap in rows:
+        caps[member_id] = cap
+    for m in members:
+        if m.rank_no in rank_caps:
+            caps[m.pk] = rank_caps[m.rank_no]
+    return {member_id: cap for member_id, cap in caps.items() if cap is not None}
+
+
+def split_capped_pairs(new_pairs, today_pairs, cap):
+    """(paid, flushed) split of new_pairs for a member who was already paid today_pairs today."""
+    if cap is None:
+        return new_pairs, 0
+    paid = max(0, min(new_pairs, cap - today_pairs))
+    return paid, new_pairs - paid
+
+
 def update_matching_income(member_plan):
     """
     Update matching pairs, rank, and matching income for each head member up the chain.
-    This function mirrors your original logic but is cleaned for clarity.
+    Pairs come from the maintained left/right_active_count counters, and all uplines
+    are read in one query, so the cost is O(depth) counter reads instead of subtree scans.
     - member_plan: MemberPlan instance whose purchase triggered the update.
     """
+    from mlm.services import CommissionAccumulator, recompute_ranks
+
     try:
         member = member_plan.member
-        # traverse to immediate head (Member instance) via member.head_member (User) -> Member
-        parent_user = member.head_member
-        if not parent_user:
-            return
-
-        # iterate uplines until admin or None
-        while parent_user:
-            try:
-                parent_member = Member.objects.get(user=parent_user)
-            except Member.DoesNotExist:
+        earners = []  # (upline, new_pairs)
+        for index, parent_member in enumerate(member.get_uplines()):
+            # stop at the admin account (it never earns matching income)
+            if index and parent_member.user.username.lower() == 'admin':
                 break
-
-            # counts on left/right active members
-            left_counts = parent_member.count_team_members('left')
-            right_counts = parent_member.count_team_members('right')
-            all_left_active = left_counts.get('active', 0)
-            all_right_active = right_counts.get('active', 0)
-
-            current_matching_pairs = min(all_left_active, all_right_active)
+            current_matching_pairs = min(parent_member.left_active_count, parent_member.right_active_count)
             new_pairs = current_matching_pairs - parent_member.all_matching_pairs
-
             if new_pairs > 0:
-                last_plan = parent_member.plans.last()
-                if not last_plan:
-                    # if upline has no plan, use the purchased plan amount as fallback
-                    base_matching_amount = Decimal(member_plan.plan.matching)
-                else:
-                    base_matching_amount = Decimal(last_plan.plan.matching)
-
-                # credit matching income per new pair (original logic used absolute matching amount)
-                total_matching_income = base_matching_amount * Decimal(new_pairs)
-
-                parent_member.matching_income += total_matching_income
-                parent_member.total_income += total_matching_income
-                parent_member.today_income += total_matching_income
-                parent_member.account_balance += total_matching_income
-                parent_member.all_matching_pairs += new_pairs
-                parent_member.matching_pairs += new_pairs
-                parent_member.save(update_fields=[
-                    'matching_income', 'total_income', 'today_income', 'account_balance',
-                    'all_matching_pairs', 'matching_pairs'
-                ])
-
-                # log income history (one entry per credit)
-                IncomeHistory.objects.create(
-                    member=parent_member,
-                    income_type=IncomeHistory.INCOME_MATCHING,
-                    amount=total_matching_income,
-                    description=f"Matching income for {new_pairs} new pair(s) from purchase by {member.user.username}"
-                )
+                earners.append((parent_member, new_pairs))
+        if not earners:
+            return
 
-                # update rank if needed
-                parent_member.update_rank_if_needed()
-
-                # deduct from company wallet if available
-                try:
-                    company_wallet, _ = CompanyWallet.objects.get_or_create(pk=1)
-                    # Attempt safe deduct (wrap in try to avoid hard failures)
-                    try:
-                        company_wallet.deduct_from_wallet(total_matching_income)
-                    except Exception:
-                        logger.exception("Company wallet deduction failed for matching income.")
-                except Exception:
-                    logger.exception("Company wallet get/create failed.")
-
-            # move up
-            if parent_member.head_member:
-                parent_user = parent_member.head_member
-                if getattr(parent_user, 'username', '').lower() == 'admin':
-                    break
-            else:
-                break
+        # matching amount per pair: the upline's plan, else the purchased plan
+        matching_rates = get_matching_rates([m.pk for m, _ in earners])
+        pair_caps = get_daily_pair_caps([m for m, _ in earners])
+
+        credits = CommissionAccumulator()
+        pair_whens, paid_whens, flushed = [], [], []
+        for parent_member, new_pairs in earners:
+            paid, flushed_pairs = split_capped_pairs(new_pairs, parent_member.today_pairs, pair_caps.get(parent_member.pk))
+            base_matching_amount = Decimal(matching_rates.get(parent_member.pk, member_plan.plan.matching))
+            credits.add(parent_member.pk, base_matching_amount * Decimal(paid), IncomeHistory.INCOME_MATCHING,
+                        f"Matching income for {paid} new pair(s) from purchase by {member.user.username}")
+            if flushed_pairs:
+                flushed.append(FlushedPairs(member_id=parent_member.pk, pairs=flushed_pairs,
+                                            daily_cap=pair_caps[parent_member.pk]))
+            # flushed pairs are consumed too, so they are never paid later
+            pair_whens.append(models.When(pk=parent_member.pk, then=models.Value(new_pairs)))
+            paid_whens.append(models.When(pk=parent_member.pk, then=models.Value(paid)))
+            parent_member.all_matching_pairs += new_pairs
+            parent_member.matching_pairs += paid
+            parent_member.today_pairs += paid
+
+        with transaction.atomic():
+            # an uncovered payout raises here and rolls the pairs back, so they are paid later
+            CompanyWallet.objects.get_or_create(pk=1)[0].deduct_from_wallet(credits.total)
+            new_pairs_case = models.Case(*pair_whens, default=models.Value(0), output_field=models.PositiveIntegerField())
+            paid_case = models.Case(*paid_whens, default=models.Value(0), output_field=models.PositiveIntegerField())
+            Member.objects.filter(pk__in=[m.pk for m, _ in earners]).update(
+                all_matching_pairs=F('all_matching_pairs') + new_pairs_case,
+                matching_pairs=F('matching_pairs') + paid_case,
+                today_pairs=F('today_pairs') + paid_case,
+            )
+            FlushedPairs.objects.bulk_create(flushed)
+            credits.flush()
+
+        # update rank if needed (one bulk pass for every earner)
+        recompute_ranks([m.pk for m, _ in earners])
 
     except Exception as e:
         logger.exception("Error in update_matching_income: %s", e)
-
-
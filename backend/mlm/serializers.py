@@ -3,7 +3,7 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import (
     Member, MemberBankDetails, Plan, Level, RankAndRewards, MemberPlan,
-    IncomeHistory, WalletTransaction, PaymentRequest, CompanyWallet, DirectTeam
+    IncomeHistory, WalletTransaction, PaymentRequest, CompanyWallet, CommissionJob
 )
 
 User = get_user_model()
@@ -39,10 +39,18 @@ class MemberBankSerializer(serializers.ModelSerializer):
         fields = ['id', 'member', 'upi_id', 'bank_name', 'bank_account', 'bank_ifsc']
 
 
+class MemberSimpleSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+
+    class Meta:
+        model = Member
+        fields = ['id', 'username']
+
+
 class MemberSerializer(serializers.ModelSerializer):
     user = UserSimpleSerializer(read_only=True)
-    sponsor = UserSimpleSerializer(read_only=True)
-    head_member = UserSimpleSerializer(read_only=True)
+    sponsor = MemberSimpleSerializer(read_only=True)
+    head_member = MemberSimpleSerializer(read_only=True)
 
     class Meta:
         model = Member
@@ -56,7 +64,14 @@ class MemberPlanSerializer(serializers.ModelSerializer):
     class Meta:
         model = MemberPlan
         fields = ['id', 'member', 'plan', 'plan_id', 'purchased_date', 'status']
-        read_only_fields = ['purchased_date', 'plan']
+        # completion (and the commissions it pays) goes through the staff-only mark_complete action
+        read_only_fields = ['purchased_date', 'plan', 'status']
+
+
+class CommissionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CommissionJob
+        fields = ['member_plan', 'status', 'attempts', 'result', 'last_error', 'created_at', 'updated_at']
 
 
 class IncomeHistorySerializer(serializers.ModelSerializer):
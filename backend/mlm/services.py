@@ -1,17 +1,31 @@
 # mlm/services.py
+from collections import defaultdict
+from datetime import timedelta
 from decimal import Decimal
-from django.db import transaction
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.db.models.functions import Least
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from .models import (
-    MemberPlan, Member, Plan, Level, IncomeHistory, WalletTransaction, CompanyWallet, MemberPlan
+    MemberPlan, Member, Plan, Level, IncomeHistory, IncomeDailyRollup, WalletTransaction, CompanyWallet, MemberPlan,
+    BinaryClosing, CommissionJob, MemberClosure, RankAndRewards, FlushedPairs, get_matching_rates,
+    get_daily_pair_caps, split_capped_pairs
 )
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
 TDS_PERCENT = Decimal('10.0')  # 10% TDS on payouts (applied when users withdraw)
+COMMISSION_LEVELS = 10  # level / resale income depth
+GENEALOGY_DEFAULT_DEPTH = 3
+GENEALOGY_MAX_DEPTH = 8  # at most 2^9 - 1 nodes per genealogy response
+PLACEMENT_RETRIES = 5  # re-plans when a leg tail moved between planning and locking
+AMOUNT_FIELD = models.DecimalField(max_digits=18, decimal_places=2)
 
 def safe_decimal(v):
     return v if isinstance(v, Decimal) else Decimal(str(v or '0.00'))
@@ -20,149 +34,687 @@ def safe_decimal(v):
 @transaction.atomic
 def process_commissions_for_purchase(member_plan: MemberPlan):
     """
-    Main entry: called when MemberPlan.mark_completed is called.
+    Main entry: called for a completed MemberPlan (through run_commission_job).
     Distributes Direct Income, Level Income, Resale Income, and triggers matching update.
     """
     try:
         member = member_plan.member
-        plan = member_plan.plan
 
         # Ensure company wallet exists
         company_wallet, _ = CompanyWallet.objects.get_or_create(pk=1)
 
-        # 1) Direct Income: pay to sponsor (if exists)
-        sponsor_user = member.sponsor
-        direct_paid = Decimal('0.00')
-        if sponsor_user:
-            try:
-                sponsor_member = Member.objects.get(user=sponsor_user)
-                direct_paid = safe_decimal(plan.direct)
-                _credit_member(sponsor_member, direct_paid, IncomeHistory.INCOME_DIRECT,
-                               f"Direct income from purchase of {member.user.username} for plan {plan.name}")
-                # deduct from company wallet
-                try:
-                    company_wallet.deduct_from_wallet(direct_paid)
-                except Exception:
-                    logger.exception("Company wallet deduct failed for direct income.")
-            except Member.DoesNotExist:
-                logger.exception("Sponsor Member not found for user %s", sponsor_user)
-
-        # 2) Level Income: traverse uplines upto 10 levels and distribute Level.distributed_amount
-        level_paid_total = Decimal('0.00')
-        current_user = member.head_member
-        level_index = 1
-        while current_user and level_index <= 10:
-            try:
-                upline_member = Member.objects.get(user=current_user)
-            except Member.DoesNotExist:
-                break
+        # Up to 10 upline ids straight from the materialized path (the plan's level table
+        # comes from cache); the level and resale passes share them.
+        upline_ids = member.get_upline_ids(COMMISSION_LEVELS)
+        credits = CommissionAccumulator()
+        summary = _collect_purchase_credits(member_plan, upline_ids, credits)
 
-            try:
-                level_conf = Level.objects.get(plan=plan, level=level_index)
-                amount = safe_decimal(level_conf.distributed_amount)
-                if amount > 0:
-                    _credit_member(upline_member, amount, IncomeHistory.INCOME_LEVEL,
-                                   f"Level {level_index} income from purchase by {member.user.username}")
-                    level_paid_total += amount
-                    try:
-                        company_wallet.deduct_from_wallet(amount)
-                    except Exception:
-                        logger.exception("Company wallet deduct failed for level income.")
-            except Level.DoesNotExist:
-                # skip if no configuration
-                pass
-
-            # move up
-            if upline_member.head_member:
-                current_user = upline_member.head_member
-            else:
-                break
-            level_index += 1
-
-        # 3) Resale Income: distribute resale percentage for levels configured
-        resale_paid_total = Decimal('0.00')
-        current_user = member.head_member
-        level_index = 1
-        while current_user and level_index <= 10:
-            try:
-                upline_member = Member.objects.get(user=current_user)
-            except Member.DoesNotExist:
-                break
+        # Write every credit of this purchase in bulk, then settle the company wallet once;
+        # if the wallet cannot cover it the whole purchase rolls back (the job is retried)
+        credits.flush()
+        company_wallet.deduct_from_wallet(credits.total)
 
+        # 4) Matching income: paid by the periodic binary closing (run_binary_closing)
+        #    unless MLM_INLINE_MATCHING asks for the per-purchase walk
+        if getattr(settings, 'MLM_INLINE_MATCHING', False):
+            from .models import update_matching_income
             try:
-                level_conf = Level.objects.get(plan=plan, level=level_index)
-                resale_pct = safe_decimal(level_conf.resale_percentage)
-                if resale_pct > 0:
-                    resale_amount = (plan.price * resale_pct / Decimal('100.00')).quantize(Decimal('0.01'))
-                    _credit_member(upline_member, resale_amount, IncomeHistory.INCOME_RESALE,
-                                   f"Resale level {level_index} income from purchase by {member.user.username}")
-                    resale_paid_total += resale_amount
-                    try:
-                        company_wallet.deduct_from_wallet(resale_amount)
-                    except Exception:
-                        logger.exception("Company wallet deduct failed for resale income.")
-            except Level.DoesNotExist:
-                pass
-
-            if upline_member.head_member:
-                current_user = upline_member.head_member
-            else:
-                break
-            level_index += 1
-
-        # 4) Matching income: call update_matching_income (it will itself create IncomeHistory)
-        from .models import update_matching_income
-        try:
-            update_matching_income(member_plan)
-        except Exception:
-            logger.exception("update_matching_income failed for member_plan %s", member_plan.pk)
+                update_matching_income(member_plan)
+            except Exception:
+                logger.exception("update_matching_income failed for member_plan %s", member_plan.pk)
 
         # (Optional) Return a summary
-        return {
-            'direct_paid': float(direct_paid),
-            'level_paid_total': float(level_paid_total),
-            'resale_paid_total': float(resale_paid_total)
-        }
+        return summary
 
     except Exception as exc:
         logger.exception("process_commissions_for_purchase failed: %s", exc)
         raise
 
 
-def _credit_member(member_obj: Member, amount: Decimal, income_type: str, description: str):
+def _collect_purchase_credits(member_plan, upline_ids, credits):
     """
-    Credit amount to a member's wallet/account, record IncomeHistory and WalletTransaction.
+    Add the direct, level and resale credits of one purchase to `credits`.
+    upline_ids: placement ancestors of the buyer, nearest first (at most COMMISSION_LEVELS).
+    Returns the per-purchase summary.
     """
-    try:
+    member = member_plan.member
+    plan = member_plan.plan
+    level_confs = Level.for_plan(plan.pk)
+
+    # 1) Direct Income: pay to sponsor (if exists)
+    direct_paid = Decimal('0.00')
+    if member.sponsor_id:
+        direct_paid = safe_decimal(plan.direct)
+        credits.add(member.sponsor_id, direct_paid, IncomeHistory.INCOME_DIRECT,
+                    f"Direct income from purchase of {member.user.username} for plan {plan.name}")
+
+    # 2) Level Income: distribute Level.distributed_amount to uplines upto 10 levels
+    level_paid_total = Decimal('0.00')
+    for level_index, upline_id in enumerate(upline_ids, start=1):
+        if level_index not in level_confs:
+            # skip if no configuration
+            continue
+        amount = safe_decimal(level_confs[level_index][0])
+        if amount > 0:
+            credits.add(upline_id, amount, IncomeHistory.INCOME_LEVEL,
+                        f"Level {level_index} income from purchase by {member.user.username}")
+            level_paid_total += amount
+
+    # 3) Resale Income: distribute resale percentage for levels configured
+    resale_paid_total = Decimal('0.00')
+    for level_index, upline_id in enumerate(upline_ids, start=1):
+        if level_index not in level_confs:
+            continue
+        resale_pct = safe_decimal(level_confs[level_index][1])
+        if resale_pct > 0:
+            resale_amount = (plan.price * resale_pct / Decimal('100.00')).quantize(Decimal('0.01'))
+            credits.add(upline_id, resale_amount, IncomeHistory.INCOME_RESALE,
+                        f"Resale level {level_index} income from purchase by {member.user.username}")
+            resale_paid_total += resale_amount
+
+    return {
+        'direct_paid': float(direct_paid),
+        'level_paid_total': float(level_paid_total),
+        'resale_paid_total': float(resale_paid_total)
+    }
+
+
+@transaction.atomic
+def process_commissions_for_plans(member_plans):
+    """
+    Batch path for many MemberPlans (e.g. the admin "mark completed" action):
+    completes pending plans, activates their buyers with set-based counter updates,
+    resolves every buyer's uplines from the materialized paths and writes all credits through a
+    single CommissionAccumulator (one row update per receiving member).
+    Plans whose CommissionJob is already DONE are skipped.
+    Returns {member_plan_id: summary dict or 'already processed'}.
+    """
+    plan_ids = [getattr(mp, 'pk', mp) for mp in member_plans]
+    plans = list(MemberPlan.objects.select_for_update(of=('self',))
+                 .filter(pk__in=plan_ids).select_related('member__user', 'plan').order_by('pk'))
+    if not plans:
+        return {}
+
+    # 1) complete pending plans and activate their buyers
+    now = timezone.now()
+    pending_ids = [mp.pk for mp in plans if mp.status != MemberPlan.STATUS_COMPLETED]
+    MemberPlan.objects.filter(pk__in=pending_ids).update(status=MemberPlan.STATUS_COMPLETED, completed_at=now)
+    Member.activate_many({mp.member_id for mp in plans})
+    MemberClosure.add_plan_volume(pending_ids)
+
+    # 2) one idempotency record per plan; DONE jobs are never paid again
+    CommissionJob.objects.bulk_create([CommissionJob(member_plan_id=mp.pk) for mp in plans], ignore_conflicts=True)
+    jobs = {job.member_plan_id: job for job in
+            CommissionJob.objects.select_for_update().filter(member_plan_id__in=[mp.pk for mp in plans])}
+    todo = [mp for mp in plans if jobs[mp.pk].status != CommissionJob.STATUS_DONE]
+
+    # 3) uplines of every buyer, resolved exactly like the single-purchase path: parsed from
+    #    the materialized path (no query), with get_upline_ids' fallbacks for unbackfilled rows
+    uplines = {}
+    for mp in todo:
+        if mp.member_id not in uplines:
+            uplines[mp.member_id] = mp.member.get_upline_ids(COMMISSION_LEVELS)
+
+    # 4) collect and write every credit together
+    credits = CommissionAccumulator()
+    results = {mp.pk: 'already processed' for mp in plans}
+    for mp in todo:
+        results[mp.pk] = _collect_purchase_credits(mp, uplines[mp.member_id], credits)
+    credits.flush()
+    CompanyWallet.objects.get_or_create(pk=1)[0].deduct_from_wallet(credits.total)
+
+    if getattr(settings, 'MLM_INLINE_MATCHING', False):
+        from .models import update_matching_income
+        for mp in todo:
+            update_matching_income(mp)
+
+    done = []
+    for mp in todo:
+        job = jobs[mp.pk]
+        job.status = CommissionJob.STATUS_DONE
+        job.attempts += 1
+        job.result = results[mp.pk]
+        job.last_error = None
+        done.append(job)
+    CommissionJob.objects.bulk_update(done, ['status', 'attempts', 'result', 'last_error'])
+    return results
+
+
+def enqueue_commissions(member_plan: MemberPlan):
+    """
+    Create (or reuse) the CommissionJob of a completed MemberPlan and process it:
+    on a Celery worker after commit when MLM_ASYNC_COMMISSIONS is on, inline otherwise.
+    """
+    job, _ = CommissionJob.objects.get_or_create(member_plan=member_plan)
+    if job.status == CommissionJob.STATUS_DONE:
+        return job
+    if getattr(settings, 'MLM_ASYNC_COMMISSIONS', False):
+        from .tasks import process_commission_job
+        transaction.on_commit(lambda: process_commission_job.delay(job.pk))
+        return job
+    return run_commission_job(job.pk)
+
+
+def run_commission_job(job_id):
+    """
+    Process one CommissionJob at most once. The job row is locked while the credits
+    are written and flipped to DONE in the same transaction; a concurrent or repeated
+    run waits on the lock and then sees DONE. Failures are recorded on the job
+    (status FAILED, last_error) and can be retried.
+    """
+    # make the PROCESSING state visible to the status endpoint
+    with transaction.atomic():
+        job = CommissionJob.objects.select_for_update().get(pk=job_id)
+        if job.status == CommissionJob.STATUS_DONE:
+            return job
+        job.status = CommissionJob.STATUS_PROCESSING
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated_at'])
+
+    with transaction.atomic():
+        job = (CommissionJob.objects.select_for_update(of=('self',))
+               .select_related('member_plan__member__user', 'member_plan__plan').get(pk=job_id))
+        if job.status == CommissionJob.STATUS_DONE:
+            return job
+        try:
+            job.result = process_commissions_for_purchase(job.member_plan)
+            job.status = CommissionJob.STATUS_DONE
+            job.last_error = None
+        except Exception as exc:
+            logger.exception("Commission job %s failed", job_id)
+            job.status = CommissionJob.STATUS_FAILED
+            job.last_error = str(exc)
+        job.save(update_fields=['status', 'result', 'last_error', 'updated_at'])
+    return job
+
+
+
+def retry_commission_jobs(max_attempts=None, stale_after=None):
+    """
+    Retry sweep for CommissionJobs nobody is going to finish: FAILED jobs, and PENDING or
+    PROCESSING jobs untouched for `stale_after` seconds (the queued task was lost or the
+    worker died between its two transactions). Jobs that already used max_attempts
+    (MLM_COMMISSION_MAX_ATTEMPTS) stay FAILED for an admin to look at. Every retry goes
+    through run_commission_job, so a job finished in the meantime is not paid twice.
+    Returns the number of retried jobs per resulting status.
+    """
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'MLM_COMMISSION_MAX_ATTEMPTS', 5)
+    if stale_after is None:
+        stale_after = getattr(settings, 'MLM_COMMISSION_STALE_AFTER', 900)
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    job_ids = list(
+        CommissionJob.objects.filter(attempts__lt=max_attempts)
+        .filter(Q(status=CommissionJob.STATUS_FAILED)
+                | Q(status__in=[CommissionJob.STATUS_PENDING, CommissionJob.STATUS_PROCESSING], updated_at__lt=cutoff))
+        .order_by('pk').values_list('pk', flat=True)
+    )
+    outcome = defaultdict(int)
+    for job_id in job_ids:
+        outcome[run_commission_job(job_id).status] += 1
+    return dict(outcome)
+
+class CommissionAccumulator:
+    """
+    Collects credits for one unit of work (e.g. a purchase) and writes them in bulk:
+    one bulk_create for IncomeHistory, one for WalletTransaction and one CASE UPDATE
+    for the affected Member rows, instead of three round-trips per credit.
+    """
+    BALANCE_FIELDS = ('account_balance', 'wallet_balance', 'total_income', 'today_income')
+    INCOME_FIELDS = {
+        IncomeHistory.INCOME_DIRECT: 'direct_income',
+        IncomeHistory.INCOME_LEVEL: 'level_income',
+        IncomeHistory.INCOME_RESALE: 'resale_income',
+        IncomeHistory.INCOME_MATCHING: 'matching_income',
+    }
+
+    def __init__(self):
+        self.credits = []  # (member_id, amount, income_type, description)
+        self.total = Decimal('0.00')
+
+    def add(self, member_id, amount, income_type, description):
         amt = safe_decimal(amount)
         if amt <= 0:
             return
-        # credit account_balance and wallet_balance
-        member_obj.account_balance += amt
-        member_obj.wallet_balance += amt
-        member_obj.total_income += amt
-        member_obj.today_income += amt
-        # track type-specific counters
-        if income_type == IncomeHistory.INCOME_DIRECT:
-            member_obj.direct_income += amt
-        elif income_type == IncomeHistory.INCOME_LEVEL:
-            member_obj.level_income += amt
-        elif income_type == IncomeHistory.INCOME_RESALE:
-            member_obj.resale_income += amt
-        elif income_type == IncomeHistory.INCOME_MATCHING:
-            member_obj.matching_income += amt
-
-        member_obj.save(update_fields=[
-            'account_balance', 'wallet_balance', 'total_income', 'today_income',
-            'direct_income', 'level_income', 'resale_income', 'matching_income'
-        ])
-
-        # create income history
-        IncomeHistory.objects.create(member=member_obj, income_type=income_type, amount=amt, description=description)
-
-        # create wallet transaction
-        WalletTransaction.objects.create(user=member_obj, transaction_type=WalletTransaction.TRANSACTION_CREDIT,
-                                         amount=amt, balance_after=member_obj.wallet_balance, description=description)
-    except Exception:
-        logger.exception("Failed to credit member %s amount %s", getattr(member_obj, 'pk', None), amount)
-        raise
+        self.credits.append((member_id, amt, income_type, description))
+        self.total += amt
+
+    @transaction.atomic
+    def flush(self):
+        """Write all collected credits. Returns {member_id: {field: amount}} of what was applied."""
+        if not self.credits:
+            return {}
+
+        member_ids = sorted({member_id for member_id, *_ in self.credits})
+        # lock the receiving rows in a stable order and read their current wallet balance
+        balances = dict(
+            Member.objects.select_for_update().filter(pk__in=member_ids).order_by('pk')
+            .values_list('pk', 'wallet_balance')
+        )
+
+        histories, transactions = [], []
+        deltas = {member_id: defaultdict(Decimal) for member_id in member_ids}
+        for member_id, amt, income_type, description in self.credits:
+            if member_id not in balances:
+                logger.error("Skipping credit of %s to missing member %s", amt, member_id)
+                continue
+            balances[member_id] += amt
+            histories.append(IncomeHistory(member_id=member_id, income_type=income_type,
+                                           amount=amt, description=description))
+            transactions.append(WalletTransaction(user_id=member_id, transaction_type=WalletTransaction.TRANSACTION_CREDIT,
+                                                  amount=amt, balance_after=balances[member_id], description=description))
+            for field in self.BALANCE_FIELDS:
+                deltas[member_id][field] += amt
+            if income_type in self.INCOME_FIELDS:
+                deltas[member_id][self.INCOME_FIELDS[income_type]] += amt
+
+        IncomeHistory.objects.bulk_create(histories)
+        WalletTransaction.objects.bulk_create(transactions)
+        IncomeDailyRollup.add_many(histories)
+
+        updates = {}
+        for field in self.BALANCE_FIELDS + tuple(self.INCOME_FIELDS.values()):
+            whens = [When(pk=member_id, then=Value(delta[field])) for member_id, delta in deltas.items() if delta.get(field)]
+            if whens:
+                updates[field] = F(field) + Case(*whens, default=Value(Decimal('0.00')), output_field=AMOUNT_FIELD)
+        if updates:
+            Member.objects.filter(pk__in=list(balances)).update(**updates)
+
+        self.credits = []
+        return deltas
+
+
+@transaction.atomic
+def run_binary_closing(until=None):
+    """
+    Batch matching ("binary closing"): pay matching income for every pair formed
+    since the previous closing in one pass instead of one upline walk per purchase.
+    Earners are selected by the counter condition itself (more active pairs in the
+    maintained left/right_active_count counters than all_matching_pairs records, one
+    locked query), so a purchase that commits late is simply paid by the next closing.
+    Pairs above a member's daily cap are flushed (consumed unpaid, recorded in
+    FlushedPairs). Credits, pair counters, ranks and the company wallet deduction are
+    then written in bulk. Completed plans not yet claimed by a closing are claimed by
+    this one (plans_processed).
+    Returns the BinaryClosing record.
+    """
+    until = until or timezone.now()
+    previous = BinaryClosing.objects.select_for_update().order_by('-period_end').first()
+    since = previous.period_end if previous else None
+
+    window = MemberPlan.objects.select_for_update().filter(
+        status=MemberPlan.STATUS_COMPLETED, closing__isnull=True, completed_at__lte=until)
+    window_plan_ids = list(window.values_list('pk', flat=True))
+
+    # every member that now has more pairs than it was paid for,
+    # locked in pk order so concurrent closings cannot pay the same pair twice
+    earners = list(
+        Member.objects.select_for_update(of=('self',))
+        .alias(unpaid_pairs=Least('left_active_count', 'right_active_count') - F('all_matching_pairs'))
+        .filter(unpaid_pairs__gt=0)
+        .exclude(user__username__iexact='admin')
+        .annotate(pairs_now=Least('left_active_count', 'right_active_count'))
+        .order_by('pk')
+    )
+
+    closing = BinaryClosing(period_start=since, period_end=until, plans_processed=len(window_plan_ids))
+    flushed = []
+    if earners:
+        earner_ids = [m.pk for m in earners]
+        matching_rates = get_matching_rates(earner_ids)
+        # fallback for uplines without a plan: the latest plan claimed in their downline this window
+        fallback_rates = {}
+        rows = (MemberPlan.objects.filter(pk__in=window_plan_ids, member__ancestor_links__ancestor_id__in=earner_ids)
+                .order_by('completed_at').values_list('member__ancestor_links__ancestor_id', 'plan__matching'))
+        for ancestor_id, matching in rows:
+            fallback_rates[ancestor_id] = matching
+        pair_caps = get_daily_pair_caps(earners)
+
+        credits = CommissionAccumulator()
+        pair_whens, paid_whens = [], []
+        for earner in earners:
+            new_pairs = earner.pairs_now - earner.all_matching_pairs
+            paid, flushed_pairs = split_capped_pairs(new_pairs, earner.today_pairs, pair_caps.get(earner.pk))
+            rate = matching_rates.get(earner.pk, fallback_rates.get(earner.pk, Decimal('0.00')))
+            credits.add(earner.pk, safe_decimal(rate) * paid, IncomeHistory.INCOME_MATCHING,
+                        f"Matching income for {paid} new pair(s) (binary closing up to {until:%Y-%m-%d %H:%M})")
+            if flushed_pairs:
+                flushed.append(FlushedPairs(member_id=earner.pk, pairs=flushed_pairs, daily_cap=pair_caps[earner.pk]))
+            pair_whens.append(When(pk=earner.pk, then=Value(new_pairs)))
+            paid_whens.append(When(pk=earner.pk, then=Value(paid)))
+            earner.all_matching_pairs += new_pairs
+            earner.matching_pairs += paid
+            earner.today_pairs += paid
+            closing.pairs += paid
+            closing.pairs_flushed += flushed_pairs
+            closing.members_credited += 1 if paid else 0
+
+        new_pairs_case = Case(*pair_whens, default=Value(0), output_field=models.PositiveIntegerField())
+        paid_case = Case(*paid_whens, default=Value(0), output_field=models.PositiveIntegerField())
+        Member.objects.filter(pk__in=earner_ids).update(
+            all_matching_pairs=F('all_matching_pairs') + new_pairs_case,
+            matching_pairs=F('matching_pairs') + paid_case,
+            today_pairs=F('today_pairs') + paid_case,
+        )
+        credits.flush()
+        recompute_ranks(earner_ids)
+
+        closing.amount = credits.total
+        CompanyWallet.objects.get_or_create(pk=1)[0].deduct_from_wallet(credits.total)
+
+    # BV carry-forward: the matched volume (the weaker leg) is flushed from both legs and only
+    # the stronger leg's surplus carries into the next closing. Both SET expressions read the
+    # pre-update row, so each Least() sees the same values.
+    matched = Least('left_bv', 'right_bv')
+    volume_holders = Member.objects.alias(matched_bv=matched).filter(matched_bv__gt=0)
+    closing.volume_matched = volume_holders.aggregate(volume=Sum(matched))['volume'] or Decimal('0.00')
+    volume_holders.update(left_bv=F('left_bv') - matched, right_bv=F('right_bv') - matched)
+
+    closing.save()
+    MemberPlan.objects.filter(pk__in=window_plan_ids).update(closing=closing)
+    if flushed:
+        for record in flushed:
+            record.closing = closing
+        FlushedPairs.objects.bulk_create(flushed)
+    return closing
+
+
+def get_genealogy(root: Member, depth=GENEALOGY_DEFAULT_DEPTH):
+    """
+    Compact binary subtree of `root`, limited to `depth` levels below it, from one
+    closure query. Nodes on the last level carry has_children but no children, so
+    the client expands them with a follow-up call rooted at that node.
+    """
+    depth = max(0, min(int(depth), GENEALOGY_MAX_DEPTH))
+    rows = (Member.objects.filter(ancestor_links__ancestor=root, ancestor_links__depth__lte=depth)
+            .order_by('ancestor_links__depth')
+            .values('id', 'user__username', 'position', 'status', 'left_count', 'right_count',
+                    'left_id', 'right_id', 'head_member_id'))
+
+    nodes = {}
+    tree = None
+    for row in rows:
+        node = {
+            'id': row['id'],
+            'username': row['user__username'],
+            'position': row['position'],
+            'status': row['status'],
+            'left_count': row['left_count'],
+            'right_count': row['right_count'],
+            'has_children': bool(row['left_id'] or row['right_id']),
+            'children': [],
+        }
+        nodes[row['id']] = node
+        parent = nodes.get(row['head_member_id']) if row['id'] != root.pk else None
+        if parent is not None:
+            parent['children'].append(node)
+        elif row['id'] == root.pk:
+            tree = node
+    if tree is None:
+        # root was never placed, so it has no index rows
+        tree = {
+            'id': root.pk, 'username': root.user.username, 'position': root.position,
+            'status': root.status, 'left_count': root.left_count, 'right_count': root.right_count,
+            'has_children': bool(root.left_id or root.right_id), 'children': [],
+        }
+    for node in nodes.values():
+        node['children'].sort(key=lambda child: child['position'] != Member.Position.LEFT)
+    return tree
+
+
+def recompute_ranks(member_ids=None, chunk_size=5000):
+    """
+    Bulk rank engine: promote members to the highest RankAndRewards tier their
+    all_matching_pairs reach. Thresholds are loaded once; each chunk of candidates is
+    locked and re-read in pk order, ranked with one vectorized searchsorted, written
+    with one CASE UPDATE, and the reward amounts of every newly reached tier are
+    credited in bulk (only for members whose rank changed). Each chunk commits on its
+    own, so the nightly full run never holds more than one chunk of row locks and a
+    concurrent promotion of the same member either lands first and is seen here or
+    waits for the chunk. Ranks never go down.
+    member_ids=None evaluates every member (nightly full recompute).
+    Returns the number of promoted members.
+    """
+    tiers = list(RankAndRewards.objects.order_by('pairs', 'rank_no')
+                 .values_list('rank_no', 'pairs', 'amount', 'rank_name', 'reward_name'))
+    if not tiers:
+        return 0
+    tier_pairs = np.array([pairs for _, pairs, *_ in tiers], dtype=np.int64)
+    # best rank reachable with at least tier_pairs[i] pairs
+    best_rank = np.maximum.accumulate(np.array([rank_no for rank_no, *_ in tiers], dtype=np.int64))
+    top_rank = int(best_rank[-1])
+
+    candidates = Member.objects.filter(all_matching_pairs__gte=int(tier_pairs[0]), rank_no__lt=top_rank)
+    if member_ids is not None:
+        candidates = candidates.filter(pk__in=list(member_ids))
+
+    promoted = 0
+    last_pk = 0
+    while True:
+        chunk_ids = list(candidates.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not chunk_ids:
+            break
+        last_pk = chunk_ids[-1]
+        with transaction.atomic():
+            rows = list(candidates.select_for_update().filter(pk__in=chunk_ids).order_by('pk')
+                        .values_list('pk', 'rank_no', 'all_matching_pairs'))
+            if not rows:
+                continue
+            data = np.array(rows, dtype=np.int64)
+            reached = np.searchsorted(tier_pairs, data[:, 2], side='right') - 1
+            new_rank = np.where(reached >= 0, best_rank[np.maximum(reached, 0)], 0)
+            changed = np.nonzero(new_rank > data[:, 1])[0]
+            if not len(changed):
+                continue
+
+            credits = CommissionAccumulator()
+            whens = []
+            for i in changed:
+                member_id, old_rank, pairs = (int(v) for v in data[i])
+                whens.append(When(pk=member_id, then=Value(int(new_rank[i]))))
+                for rank_no, tier_min_pairs, amount, rank_name, reward_name in tiers:
+                    if old_rank < rank_no <= new_rank[i] and tier_min_pairs <= pairs and amount > 0:
+                        credits.add(member_id, amount, IncomeHistory.INCOME_REWARD,
+                                    f"Rank reward: {rank_name}" + (f" ({reward_name})" if reward_name else ""))
+            Member.objects.filter(pk__in=[int(data[i, 0]) for i in changed]).update(
+                rank_no=Case(*whens, output_field=models.PositiveIntegerField())
+            )
+            credits.flush()
+            CompanyWallet.objects.get_or_create(pk=1)[0].deduct_from_wallet(credits.total)
+            promoted += len(changed)
+    return promoted
+
+
+# ledger transaction types that add to wallet_balance; every other type takes money out
+WALLET_INFLOW_TYPES = (WalletTransaction.TRANSACTION_CREDIT, WalletTransaction.TRANSACTION_RECHARGE)
+RECONCILED_FIELDS = ('wallet_balance', 'total_withdrawal', 'total_income') + tuple(CommissionAccumulator.INCOME_FIELDS.values())
+
+
+def reconcile_member_range(after_pk, last_pk, repair=False):
+    """
+    Compare the denormalized Member balances in (after_pk, last_pk] with the ledgers:
+    total_income and the per-type incomes against IncomeHistory, wallet_balance and
+    total_withdrawal against WalletTransaction. One grouped query per ledger for the
+    whole range. With repair=True the member rows are locked first (writers lock them
+    before touching the ledgers) and drifted rows are rewritten with the ledger values.
+    Returns [(member_id, {field: (stored, ledger)})] for the drifted members.
+    """
+    with transaction.atomic():
+        members = Member.objects.filter(pk__gt=after_pk, pk__lte=last_pk).order_by('pk')
+        if repair:
+            members = members.select_for_update()
+        stored = {row['pk']: row for row in members.values('pk', *RECONCILED_FIELDS)}
+        expected = {pk: dict.fromkeys(RECONCILED_FIELDS, Decimal('0.00')) for pk in stored}
+
+        incomes = (IncomeHistory.objects.filter(member_id__gt=after_pk, member_id__lte=last_pk)
+                   .values_list('member_id', 'income_type').annotate(total=Sum('amount')).order_by())
+        for member_id, income_type, total in incomes:
+            if member_id not in expected:
+                continue
+            expected[member_id]['total_income'] += total
+            if income_type in CommissionAccumulator.INCOME_FIELDS:
+                expected[member_id][CommissionAccumulator.INCOME_FIELDS[income_type]] += total
+
+        movements = (WalletTransaction.objects.filter(user_id__gt=after_pk, user_id__lte=last_pk)
+                     .values_list('user_id', 'transaction_type').annotate(total=Sum('amount')).order_by())
+        for member_id, transaction_type, total in movements:
+            if member_id not in expected:
+                continue
+            expected[member_id]['wallet_balance'] += total if transaction_type in WALLET_INFLOW_TYPES else -total
+            if transaction_type == WalletTransaction.TRANSACTION_WITHDRAWAL:
+                expected[member_id]['total_withdrawal'] += total
+
+        drift = []
+        for member_id, row in stored.items():
+            diff = {field: (row[field], expected[member_id][field])
+                    for field in RECONCILED_FIELDS if row[field] != expected[member_id][field]}
+            if diff:
+                drift.append((member_id, diff))
+
+        if repair and drift:
+            Member.objects.bulk_update(
+                [Member(pk=member_id, **expected[member_id]) for member_id, _ in drift], RECONCILED_FIELDS
+            )
+    return drift
+
+
+class StalePlacement(Exception):
+    """A planned slot was taken by a concurrent registration before its rows were locked."""
+
+
+def place_member(sponsor: Member, new_member: Member, position=None):
+    """Place one registration through the coordinator (see place_many). Returns (head, position)."""
+    return place_many([(sponsor, new_member, position)])[0]
+
+
+def place_many(registrations):
+    """
+    Placement coordinator: place [(sponsor, new_member, position)] in order, safely next to
+    concurrent registrations. The slots the batch can touch (the leg tails below each sponsor)
+    are planned without locks; then the tails, all their ancestors (every row whose tail
+    pointer or counters the placements update) and the new members are locked in ONE
+    pk-ordered SELECT FOR UPDATE, so two coordinators never wait on each other in crossed
+    order. If a planned tail was filled meanwhile, the batch is re-planned.
+    Returns [(head, position)] per registration.
+    """
+    for _ in range(PLACEMENT_RETRIES):
+        try:
+            with transaction.atomic():
+                return _place_batch(registrations)
+        except StalePlacement:
+            continue
+    raise ValidationError("Placement is busy, please try again.")
+
+
+def _place_batch(registrations):
+    new_ids = {new_member.pk for _, new_member, _ in registrations}
+    sponsors = Member.objects.in_bulk({sponsor.pk for sponsor, _, _ in registrations} - new_ids)
+
+    # plan: which existing slot can each sponsor's leg end in (both legs for auto placement)
+    planned = set()  # (tail_id, slot)
+    for sponsor, _, position in registrations:
+        if sponsor.pk in new_ids:
+            continue  # sponsored by a member of this batch: lands below an already planned tail
+        for side in ([position] if position else [Member.Position.LEFT, Member.Position.RIGHT]):
+            planned.add((sponsors[sponsor.pk].get_leg_tail(side).pk, 'left' if side == Member.Position.LEFT else 'right'))
+
+    tail_ids = {tail_id for tail_id, _ in planned}
+    ancestor_ids = set(MemberClosure.objects.filter(descendant_id__in=tail_ids).values_list('ancestor_id', flat=True))
+    locked = Member.objects.select_for_update().filter(pk__in=tail_ids | ancestor_ids | new_ids).order_by('pk')
+    locked = {member.pk: member for member in locked}
+
+    for tail_id, slot in planned:
+        if getattr(locked[tail_id], f'{slot}_id'):
+            raise StalePlacement(tail_id)
+    for new_id in new_ids:
+        member = locked[new_id]
+        if member.head_member_id or member.left_id or member.right_id:
+            raise ValidationError(f"Member {member} is already placed.")
+
+    # every row written below is locked now, so the placements themselves never wait
+    return [
+        locked.get(sponsor.pk, sponsor).assign_new_member(new_member, position=position, auto_placement=not position)
+        for sponsor, new_member, position in registrations
+    ]
+
+
+@transaction.atomic
+def relocate_subtree(member: Member, new_head: Member, position):
+    """
+    Move `member` with its whole downline into the empty `position` slot of `new_head`
+    (sponsors and the sponsor index stay as they are). Runs in bounded queries whatever
+    the subtree size:
+    - old and new ancestor chains plus both heads are locked in one pk-ordered statement
+      (chains missing from the index are indexed first, see MemberClosure.index_chain);
+    - left/right_count and left/right_active_count leave the old chain and join the new
+      one through MemberClosure.add_to_ancestors (set-based UPDATEs);
+    - closure rows linking the subtree to its old ancestors are deleted and the new ones
+      written with one INSERT ... SELECT (new head's ancestors x subtree rows);
+    - leg tails that ran through the subtree are repointed and paths/depths re-rooted.
+    Business volume already accumulated stays with the ancestors that earned it.
+    Returns (old_head, new_head).
+    """
+    if position not in (Member.Position.LEFT, Member.Position.RIGHT):
+        raise ValidationError("Position must be LEFT or RIGHT.")
+    if not member.head_member_id:
+        raise ValidationError("The tree root cannot be relocated.")
+    old_chain = MemberClosure.index_chain(member)
+    new_chain = MemberClosure.index_chain(new_head)
+    if member.pk in {ancestor_id for ancestor_id, _, _ in new_chain}:
+        raise ValidationError("A member cannot be moved into its own downline.")
+
+    chain_ids = {ancestor_id for ancestor_id, _, _ in old_chain + new_chain}
+    locked = Member.objects.select_for_update().filter(pk__in=chain_ids).order_by('pk')
+    locked = {m.pk: m for m in locked}
+    member, new_head = locked[member.pk], locked[new_head.pk]
+    old_head = locked[member.head_member_id]
+    slot = 'left' if position == Member.Position.LEFT else 'right'
+    if getattr(new_head, f'{slot}_id'):
+        raise ValidationError(f"{slot.capitalize()} position already occupied.")
+    # the subtree itself is moved set-based from its rows, so they must exist
+    subtree = MemberClosure.objects.filter(ancestor_id=member.pk)
+    child_ids = {pk for pk in (member.left_id, member.right_id) if pk}
+    if subtree.filter(descendant_id__in=child_ids).count() != len(child_ids):
+        raise ValidationError(f"The placement index below {member} is incomplete; "
+                              f"run `manage.py rebuild_tree_index` first.")
+
+    # the subtree's outer tails (walked and repaired when the pointers predate the tail fields)
+    tails = {side: member.get_leg_tail(side).pk for side in (Member.Position.LEFT, Member.Position.RIGHT)}
+    sizes = Member.objects.filter(ancestor_links__ancestor=member).aggregate(
+        members=Count('pk'), active=Count('pk', filter=Q(status=Member.Status.ACTIVE)))
+
+    # 1) detach: counters leave the old chain, old head's slot and outer chain end at the head again
+    MemberClosure.add_to_ancestors(member, 'left_count', 'right_count', -sizes['members'])
+    MemberClosure.add_to_ancestors(member, 'left_active_count', 'right_active_count', -sizes['active'])
+    old_slot = 'left' if member.position == Member.Position.LEFT else 'right'
+    old_head_chain = [ancestor_id for ancestor_id, depth, _ in old_chain if depth >= 1]
+    Member.objects.filter(
+        Q(pk__in=old_head_chain, **{f'{old_slot}_tail_id': tails[member.position]}) | Q(pk=old_head.pk)
+    ).update(**{f'{old_slot}_tail': old_head})
+    Member.objects.filter(pk=old_head.pk).update(**{old_slot: None})
+    # re-root paths now, while the subtree's old path still resolves
+    member.rewrite_subtree_paths(new_head.get_path())
+
+    # 2) re-index: drop links to the old ancestors, copy the new head's links onto every subtree row
+    subtree_ids = subtree.values('descendant_id')
+    MemberClosure.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+    table = connection.ops.quote_name(MemberClosure._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (ancestor_id, descendant_id, depth, leg) "
+            f"SELECT a.ancestor_id, s.descendant_id, a.depth + s.depth + 1, COALESCE(a.leg, %s) "
+            f"FROM {table} a, {table} s WHERE a.descendant_id = %s AND s.ancestor_id = %s",
+            [position, new_head.pk, member.pk],
+        )
+
+    # 3) attach: pointers, the new head's outer chain now ends at the subtree's tail, counters join
+    Member.objects.filter(pk=member.pk).update(head_member=new_head, position=position)
+    Member.objects.filter(pk=new_head.pk).update(**{slot: member})
+    Member.objects.filter(Q(**{f'{slot}_tail': new_head}) | Q(pk=new_head.pk)).update(
+        **{f'{slot}_tail_id': tails[position]})
+    MemberClosure.add_to_ancestors(member, 'left_count', 'right_count', sizes['members'])
+    MemberClosure.add_to_ancestors(member, 'left_active_count', 'right_active_count', sizes['active'])
+
+    logger.info("Relocated subtree of %s (%s member(s)) from %s to %s %s",
+                member.pk, sizes['members'], old_head.pk, new_head.pk, position)
+    return old_head, new_head
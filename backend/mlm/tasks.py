@@ -1,43 +1,123 @@
 # mlm/tasks.py
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
-from decimal import Decimal
-from .models import CompanyWallet, Member, IncomeHistory
+from decimal import Decimal, ROUND_DOWN
+from .models import CompanyWallet, CommissionJob, Member, IncomeHistory, IncomeDailyRollup, WalletTransaction
 import logging
 
 logger = logging.getLogger(__name__)
 
 @shared_task
-def distribute_global_pool():
+def distribute_global_pool(pool_size=None):
     """
-    Example monthly distribution: shares a small pool among top sellers (top 10 by total_income).
-    Pool = 2% of CompanyWallet.balance (or other logic).
+    Example monthly distribution: shares a small pool among top sellers (top N by total_income).
+    Pool = 2% of CompanyWallet.balance (or other logic); N = MLM_GLOBAL_POOL_SIZE unless given.
+    Set-based: the top N come from the (status, -total_income) index, all shares are applied
+    with one UPDATE and the ledger rows are bulk-created, in the same transaction as the
+    company wallet deduction.
     """
+    pool_size = pool_size or getattr(settings, 'MLM_GLOBAL_POOL_SIZE', 10)
     try:
-        wallet, _ = CompanyWallet.objects.get_or_create(pk=1)
-        pool_amount = (wallet.balance * Decimal('0.02')).quantize(Decimal('0.01'))  # 2%
-        if pool_amount <= 0:
-            return {"distributed": 0}
-
-        # Get top 10 members by total_income
-        top_members = Member.objects.filter(status=Member.STATUS_ACTIVE).order_by('-total_income')[:10]
-        if not top_members:
-            return {"distributed": 0}
-
-        share = (pool_amount / len(top_members)).quantize(Decimal('0.01'))
-
-        for m in top_members:
-            m.wallet_balance += share
-            m.total_income += share
-            m.save(update_fields=['wallet_balance', 'total_income'])
-            IncomeHistory.objects.create(member=m, income_type=IncomeHistory.INCOME_REWARD,
-                                         amount=share, description="Global pool monthly reward")
-        try:
-            wallet.deduct_from_wallet(pool_amount)
-        except Exception:
-            logger.exception("Failed to deduct company wallet for global pool")
-
-        return {"distributed": float(pool_amount), "shares": float(share)}
+        with transaction.atomic():
+            wallet, _ = CompanyWallet.objects.get_or_create(pk=1)
+            pool_amount = (wallet.get_balance() * Decimal('0.02')).quantize(Decimal('0.01'))  # 2%
+            if pool_amount <= 0:
+                return {"distributed": 0}
+
+            # Get top N active members by total_income (locked in that order)
+            top_members = list(
+                Member.objects.select_for_update().filter(status=Member.Status.ACTIVE)
+                .order_by('-total_income', 'pk').values_list('pk', 'wallet_balance')[:pool_size]
+            )
+            if not top_members:
+                return {"distributed": 0}
+
+            share = (pool_amount / len(top_members)).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+            if share <= 0:
+                return {"distributed": 0}
+            distributed = share * len(top_members)
+            # raises (and rolls everything back) if the wallet cannot cover the pool
+            wallet.deduct_from_wallet(distributed)
+
+            member_ids = [pk for pk, _ in top_members]
+            Member.objects.filter(pk__in=member_ids).update(
+                wallet_balance=F('wallet_balance') + share,
+                total_income=F('total_income') + share,
+            )
+            description = "Global pool monthly reward"
+            histories = IncomeHistory.objects.bulk_create([
+                IncomeHistory(member_id=pk, income_type=IncomeHistory.INCOME_REWARD, amount=share, description=description)
+                for pk in member_ids
+            ])
+            IncomeDailyRollup.add_many(histories)
+            WalletTransaction.objects.bulk_create([
+                WalletTransaction(user_id=pk, transaction_type=WalletTransaction.TRANSACTION_CREDIT, amount=share,
+                                  balance_after=balance + share, description=description)
+                for pk, balance in top_members
+            ])
+
+        return {"distributed": float(distributed), "shares": float(share), "members": len(member_ids)}
     except Exception:
         logger.exception("Error distributing global pool")
         raise
+
+
+@shared_task
+def compact_company_wallet():
+    """
+    Periodic step: spread the wallet reserve and the shard balances evenly over the
+    CompanyWalletShard rows, so debits keep finding a shard that covers them.
+    """
+    wallet, _ = CompanyWallet.objects.get_or_create(pk=1)
+    balance = wallet.compact()
+    return {"balance": float(balance)}
+
+
+@shared_task
+def run_binary_closing():
+    """Periodic matching closing (see mlm.services.run_binary_closing)."""
+    from .services import run_binary_closing as close
+    closing = close()
+    return {"closing": closing.pk, "pairs": closing.pairs, "amount": float(closing.amount)}
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=60)
+def process_commission_job(self, job_id):
+    """Run a CommissionJob; failed attempts are retried, finished jobs are never paid twice."""
+    from .services import run_commission_job
+    job = run_commission_job(job_id)
+    if job.status == CommissionJob.STATUS_FAILED:
+        raise self.retry(exc=RuntimeError(job.last_error))
+    return {"job": job.pk, "status": job.status}
+
+
+
+@shared_task
+def retry_commission_jobs():
+    """Periodic retry sweep for failed or stuck CommissionJobs (see mlm.services.retry_commission_jobs)."""
+    from .services import retry_commission_jobs as sweep
+    outcome = sweep()
+    if outcome:
+        logger.info("Commission jobs retried: %s", outcome)
+    return outcome
+
+@shared_task
+def recompute_all_ranks():
+    """Nightly full rank recompute (see mlm.services.recompute_ranks)."""
+    from .services import recompute_ranks
+    return {"promoted": recompute_ranks()}
+
+
+@shared_task
+def reset_daily_counters():
+    """
+    Midnight reset of per-day Member counters (today_income, today_pairs) in one UPDATE;
+    history stays in IncomeDailyRollup and FlushedPairs.
+    """
+    reset = (Member.objects.exclude(today_income=Decimal('0.00'), today_pairs=0)
+             .update(today_income=Decimal('0.00'), today_pairs=0))
+    logger.info("Daily counters reset for %s member(s)", reset)
+    return reset
@@ -1,24 +1,43 @@
 # mlm/tests.py
-from django.test import TestCase
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth import get_user_model
-from .models import Member, Plan, MemberPlan, CompanyWallet
-from .services import process_commissions_for_purchase
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .models import (
+    Member, MemberClosure, SponsorClosure, Plan, Level, RankAndRewards, MemberPlan, CommissionJob, CompanyWallet,
+    IncomeHistory, IncomeDailyRollup, WalletTransaction, FlushedPairs
+)
+from .analytics import TreeArrays
+from .tasks import distribute_global_pool, reset_daily_counters
+from .services import (
+    process_commissions_for_purchase, process_commissions_for_plans, run_binary_closing, recompute_ranks,
+    run_commission_job, enqueue_commissions, relocate_subtree, retry_commission_jobs
+)
 from decimal import Decimal
 
 User = get_user_model()
 
 class MLMBasicTests(TestCase):
     def setUp(self):
-        CompanyWallet.objects.create(balance=Decimal('100000.00'))
+        CompanyWallet.objects.create(balance=Decimal('100000.00')).compact()
         self.user_a = User.objects.create_user(username='a', password='pass')
         self.user_b = User.objects.create_user(username='b', password='pass')
-        # ensure Member created via post_save signal
-        self.member_a = Member.objects.get(user=self.user_a)
-        self.member_b = Member.objects.get(user=self.user_b)
+        # Member profiles are created alongside the user at registration
+        self.member_a = Member.objects.create(user=self.user_a)
+        self.member_b = Member.objects.create(user=self.user_b)
         # place member_b under member_a
-        self.member_b.head_member = self.user_a
-        self.member_b.sponsor = self.user_a
-        self.member_b.save()
+        self.member_a.assign_new_member(self.member_b, position=Member.Position.LEFT)
 
         self.plan = Plan.objects.create(name='Starter', price=Decimal('499.00'), direct=Decimal('50.00'), matching=Decimal('10.00'))
 
@@ -28,3 +47,709 @@ class MLMBasicTests(TestCase):
         # After processing direct income, sponsor (member_a) should have direct income credited
         self.member_a.refresh_from_db()
         self.assertGreaterEqual(self.member_a.direct_income, Decimal('50.00'))
+
+    def test_level_and_resale_income_use_resolved_uplines(self):
+        Level.objects.create(plan=self.plan, level=1, distributed_amount=Decimal('20.00'), resale_percentage=Decimal('1.00'))
+        Level.objects.create(plan=self.plan, level=2, distributed_amount=Decimal('5.00'))
+        member_c = Member.objects.create(user=User.objects.create_user(username='c', password='pass'))
+        self.member_b.assign_new_member(member_c, position=Member.Position.LEFT)
+
+        process_commissions_for_purchase(MemberPlan.objects.create(member=member_c, plan=self.plan))
+        self.member_a.refresh_from_db()
+        self.member_b.refresh_from_db()
+        self.assertEqual(self.member_b.direct_income, Decimal('50.00'))
+        self.assertEqual(self.member_b.level_income, Decimal('20.00'))
+        self.assertEqual(self.member_b.resale_income, Decimal('4.99'))
+        self.assertEqual(self.member_a.level_income, Decimal('5.00'))
+
+    def test_income_rollups_follow_credits_and_backfill(self):
+        Level.objects.create(plan=self.plan, level=1, distributed_amount=Decimal('20.00'))
+        for _ in range(2):
+            process_commissions_for_purchase(MemberPlan.objects.create(member=self.member_b, plan=self.plan))
+
+        rollup = IncomeDailyRollup.objects.get(member=self.member_a, income_type=IncomeHistory.INCOME_DIRECT)
+        self.assertEqual((rollup.amount, rollup.count), (Decimal('100.00'), 2))
+        summary = self.member_a.get_income_summary()
+        self.assertEqual(summary['today'], Decimal('140.00'))
+        self.assertEqual(summary['this_month'], Decimal('140.00'))
+        self.assertEqual(summary['by_type'][IncomeHistory.INCOME_LEVEL], Decimal('40.00'))
+
+        before = set(IncomeDailyRollup.objects.values_list('member', 'date', 'income_type', 'amount', 'count'))
+        call_command('backfill_income_rollups', chunk_size=1, stdout=StringIO())
+        after = set(IncomeDailyRollup.objects.values_list('member', 'date', 'income_type', 'amount', 'count'))
+        self.assertEqual(after, before)
+
+    def test_reconcile_balances_reports_and_repairs_drift(self):
+        process_commissions_for_purchase(MemberPlan.objects.create(member=self.member_b, plan=self.plan))
+        out = StringIO()
+        call_command('reconcile_balances', chunk_size=1, stdout=out)
+        self.assertIn('no drift', out.getvalue())
+
+        Member.objects.filter(pk=self.member_a.pk).update(wallet_balance=Decimal('7.00'), direct_income=Decimal('0.00'))
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn(f'member {self.member_a.pk}: wallet_balance 7.00 != 50.00, direct_income 0.00 != 50.00', out.getvalue())
+
+        call_command('reconcile_balances', repair=True, stdout=StringIO())
+        self.member_a.refresh_from_db()
+        self.assertEqual((self.member_a.wallet_balance, self.member_a.direct_income), (Decimal('50.00'), Decimal('50.00')))
+
+    def test_commission_writes_are_batched(self):
+        for level in range(1, 11):
+            Level.objects.create(plan=self.plan, level=level, distributed_amount=Decimal('2.00'), resale_percentage=Decimal('0.50'))
+        Level.for_plan(self.plan.pk)
+
+        def purchase_queries(buyer):
+            mp = MemberPlan.objects.create(member=Member.objects.get(pk=buyer.pk), plan=self.plan)
+            with CaptureQueriesContext(connection) as ctx:
+                process_commissions_for_purchase(mp)
+            return len(ctx.captured_queries)
+
+        shallow = purchase_queries(self.member_b)
+        head = self.member_b
+        for i in range(10):
+            child = Member.objects.create(user=User.objects.create_user(username=f'd{i}', password='pass'))
+            head.assign_new_member(child, position=Member.Position.LEFT)
+            head = child
+        self.assertEqual(purchase_queries(head), shallow)
+
+        # ledger and counters agree, and balance_after follows the running balance
+        self.member_b.refresh_from_db()
+        transactions = list(WalletTransaction.objects.filter(user=self.member_b).order_by('pk'))
+        self.assertEqual(sum(t.amount for t in transactions), self.member_b.wallet_balance)
+        self.assertEqual(transactions[-1].balance_after, self.member_b.wallet_balance)
+        self.assertEqual(IncomeHistory.objects.filter(member=self.member_b).count(), len(transactions))
+
+    @override_settings(MLM_INLINE_MATCHING=True)
+    def test_matching_income_from_active_leg_counters(self):
+        member_c = Member.objects.create(user=User.objects.create_user(username='c', password='pass'))
+        self.member_a.assign_new_member(member_c, position=Member.Position.RIGHT)
+        RankAndRewards.objects.create(rank_no=1, rank_name='Star', pairs=1)
+
+        MemberPlan.objects.create(member=self.member_b, plan=self.plan).mark_completed()
+        self.member_a.refresh_from_db()
+        self.assertEqual((self.member_a.left_active_count, self.member_a.right_active_count), (1, 0))
+        self.assertEqual(self.member_a.matching_income, Decimal('0.00'))
+
+        MemberPlan.objects.create(member=member_c, plan=self.plan).mark_completed()
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.right_active_count, 1)
+        self.assertEqual(self.member_a.all_matching_pairs, 1)
+        self.assertEqual(self.member_a.matching_income, Decimal('10.00'))
+        self.assertEqual(self.member_a.rank_no, 1)
+
+        member_c.deactivate()
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.right_active_count, 0)
+
+    def test_binary_closing_pays_new_pairs_once(self):
+        member_c = Member.objects.create(user=User.objects.create_user(username='c', password='pass'))
+        self.member_a.assign_new_member(member_c, position=Member.Position.RIGHT)
+        MemberPlan.objects.create(member=self.member_b, plan=self.plan).mark_completed()
+        MemberPlan.objects.create(member=member_c, plan=self.plan).mark_completed()
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.matching_income, Decimal('0.00'))
+
+        closing = run_binary_closing()
+        self.assertEqual((closing.plans_processed, closing.members_credited, closing.pairs), (2, 1, 1))
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.matching_income, Decimal('10.00'))
+        self.assertEqual(self.member_a.all_matching_pairs, 1)
+
+        second = run_binary_closing()
+        self.assertEqual((second.plans_processed, second.pairs), (0, 0))
+        self.assertEqual(second.period_start, closing.period_end)
+
+    def test_binary_closing_pays_plans_committed_after_the_window(self):
+        member_c = Member.objects.create(user=User.objects.create_user(username='c', password='pass'))
+        self.member_a.assign_new_member(member_c, position=Member.Position.RIGHT)
+        MemberPlan.objects.create(member=self.member_b, plan=self.plan).mark_completed()
+        first = run_binary_closing()
+        self.assertEqual((first.plans_processed, first.pairs), (1, 0))
+
+        # stamped inside the first window but committed after that closing read it
+        late = MemberPlan.objects.create(member=member_c, plan=self.plan)
+        late.mark_completed()
+        MemberPlan.objects.filter(pk=late.pk).update(completed_at=first.period_end - timedelta(minutes=1))
+
+        second = run_binary_closing()
+        self.assertEqual((second.plans_processed, second.members_credited, second.pairs), (1, 1, 1))
+        self.assertEqual(MemberPlan.objects.get(pk=late.pk).closing, second)
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.matching_income, Decimal('10.00'))
+
+    def test_daily_pair_cap_flushes_excess_pairs(self):
+        self.plan.daily_pair_cap = 1
+        self.plan.save()
+        member_c, member_d, member_e = (Member.objects.create(user=User.objects.create_user(username=name, password='pass'))
+                                        for name in ('c', 'd', 'e'))
+        self.member_a.assign_new_member(member_c, position=Member.Position.RIGHT)
+        self.member_b.assign_new_member(member_d, position=Member.Position.LEFT)
+        member_c.assign_new_member(member_e, position=Member.Position.RIGHT)
+        for member in (self.member_a, self.member_b, member_c, member_d, member_e):
+            MemberPlan.objects.create(member=member, plan=self.plan).mark_completed()
+
+        closing = run_binary_closing()
+        self.assertEqual((closing.pairs, closing.pairs_flushed), (1, 1))
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.matching_income, Decimal('10.00'))
+        self.assertEqual((self.member_a.today_pairs, self.member_a.all_matching_pairs), (1, 2))
+        flushed = FlushedPairs.objects.get(member=self.member_a)
+        self.assertEqual((flushed.pairs, flushed.daily_cap, flushed.closing), (1, 1, closing))
+
+        reset_daily_counters()
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.today_pairs, 0)
+
+    def test_leg_volume_accumulates_and_carries_forward(self):
+        member_c = Member.objects.create(user=User.objects.create_user(username='c', password='pass'))
+        self.member_a.assign_new_member(member_c, position=Member.Position.RIGHT)
+        premium = Plan.objects.create(name='Premium', price=Decimal('999.00'))
+        MemberPlan.objects.create(member=self.member_b, plan=self.plan).mark_completed()
+        process_commissions_for_plans([MemberPlan.objects.create(member=member_c, plan=premium)])
+        self.member_a.refresh_from_db()
+        self.assertEqual((self.member_a.left_bv, self.member_a.right_bv), (Decimal('499.00'), Decimal('999.00')))
+
+        stale_copy = MemberPlan.objects.filter(member=self.member_b).first()
+        stale_copy.status = MemberPlan.STATUS_PENDING  # e.g. a double-submitted mark_complete
+        self.assertIsNone(stale_copy.mark_completed())
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.total_left_bv, Decimal('499.00'))
+
+        closing = run_binary_closing()
+        self.assertEqual(closing.volume_matched, Decimal('499.00'))
+        self.member_a.refresh_from_db()
+        self.assertEqual((self.member_a.left_bv, self.member_a.right_bv), (Decimal('0.00'), Decimal('500.00')))
+        self.assertEqual((self.member_a.total_left_bv, self.member_a.total_right_bv),
+                         (Decimal('499.00'), Decimal('999.00')))
+
+    def test_commission_job_is_paid_at_most_once(self):
+        mp = MemberPlan.objects.create(member=self.member_b, plan=self.plan)
+        job = mp.mark_completed()
+        self.assertEqual(job.status, CommissionJob.STATUS_DONE)
+        self.assertEqual(job.result['direct_paid'], 50.0)
+
+        run_commission_job(job.pk)
+        enqueue_commissions(mp)
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.direct_income, Decimal('50.00'))
+        self.assertEqual(CommissionJob.objects.get(pk=job.pk).attempts, 1)
+
+    def test_retry_sweep_reruns_failed_and_stuck_jobs(self):
+        def job(status, attempts, stale=False):
+            job = CommissionJob.objects.create(member_plan=MemberPlan.objects.create(member=self.member_b, plan=self.plan),
+                                               status=status, attempts=attempts)
+            if stale:
+                CommissionJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+            return job.pk
+
+        failed = job(CommissionJob.STATUS_FAILED, 1)
+        stuck = job(CommissionJob.STATUS_PROCESSING, 1, stale=True)
+        exhausted = job(CommissionJob.STATUS_FAILED, 5)
+        running = job(CommissionJob.STATUS_PROCESSING, 1)
+
+        self.assertEqual(retry_commission_jobs(max_attempts=5, stale_after=900), {CommissionJob.STATUS_DONE: 2})
+        statuses = dict(CommissionJob.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[pk] for pk in (failed, stuck, exhausted, running)],
+                         [CommissionJob.STATUS_DONE, CommissionJob.STATUS_DONE,
+                          CommissionJob.STATUS_FAILED, CommissionJob.STATUS_PROCESSING])
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.direct_income, Decimal('100.00'))
+        self.assertEqual(retry_commission_jobs(max_attempts=5, stale_after=900), {})
+
+    @override_settings(MLM_ASYNC_COMMISSIONS=True)
+    def test_mark_complete_endpoint_queues_commissions(self):
+        client = APIClient()
+        client.force_authenticate(self.user_b)
+        response = client.post(reverse('memberplan-list'), {'plan_id': self.plan.pk, 'status': MemberPlan.STATUS_COMPLETED})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], MemberPlan.STATUS_PENDING)
+        self.assertEqual(response.data['member']['sponsor']['username'], 'a')
+        mp = MemberPlan.objects.get(pk=response.data['id'])
+        # only staff confirm payments; members cannot complete their own plans
+        self.assertEqual(client.post(reverse('memberplan-mark-complete', args=[mp.pk])).status_code, 403)
+        self.assertEqual(client.get(reverse('member-detail', args=[self.member_a.pk])).status_code, 404)
+
+        client.force_authenticate(User.objects.create_user(username='staff', password='pass', role=User.Role.ADMIN))
+        with mock.patch('mlm.tasks.process_commission_job.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(reverse('memberplan-mark-complete', args=[mp.pk]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['commission']['status'], CommissionJob.STATUS_PENDING)
+        delay.assert_called_once_with(mp.commission_job.pk)
+
+        run_commission_job(mp.commission_job.pk)
+        response = client.get(reverse('memberplan-commission-status', args=[mp.pk]))
+        self.assertEqual(response.data['status'], CommissionJob.STATUS_DONE)
+
+    def test_batch_processing_matches_single_purchase_path(self):
+        Level.objects.create(plan=self.plan, level=1, distributed_amount=Decimal('20.00'), resale_percentage=Decimal('1.00'))
+        buyers = [self.member_b]
+        for name in ('c', 'd', 'e'):
+            buyer = Member.objects.create(user=User.objects.create_user(username=name, password='pass'))
+            self.member_a.assign_new_member(buyer)
+            buyers.append(buyer)
+        plans = [MemberPlan.objects.create(member=buyer, plan=self.plan) for buyer in buyers]
+        Level.for_plan(self.plan.pk)
+
+        with CaptureQueriesContext(connection) as small_batch:
+            process_commissions_for_plans(plans[:1])
+        with CaptureQueriesContext(connection) as large_batch:
+            results = process_commissions_for_plans(plans)
+        self.assertEqual(len(small_batch.captured_queries), len(large_batch.captured_queries))
+
+        self.assertEqual(results[plans[0].pk], 'already processed')
+        self.assertEqual(results[plans[1].pk]['direct_paid'], 50.0)
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.direct_income, Decimal('200.00'))
+        self.assertEqual(self.member_a.left_active_count + self.member_a.right_active_count, 4)
+        self.assertFalse(CommissionJob.objects.exclude(status=CommissionJob.STATUS_DONE).exists())
+
+    def test_batch_and_single_paths_agree_on_unindexed_tree(self):
+        Level.objects.create(plan=self.plan, level=1, distributed_amount=Decimal('20.00'))
+        MemberClosure.objects.all().delete()  # tree placed before the index and paths existed
+        Member.objects.update(path='')
+
+        process_commissions_for_plans([MemberPlan.objects.create(member=self.member_b, plan=self.plan)])
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.level_income, Decimal('20.00'))
+        process_commissions_for_purchase(MemberPlan.objects.create(member=self.member_b, plan=self.plan))
+        self.member_a.refresh_from_db()
+        self.assertEqual(self.member_a.level_income, Decimal('40.00'))
+
+    def test_bulk_rank_recompute_pays_rewards_once(self):
+        RankAndRewards.objects.create(rank_no=1, rank_name='Star', pairs=2, amount=Decimal('100.00'))
+        RankAndRewards.objects.create(rank_no=2, rank_name='Gold', pairs=5, amount=Decimal('500.00'), reward_name='Trip')
+        Member.objects.filter(pk=self.member_a.pk).update(all_matching_pairs=6)
+        Member.objects.filter(pk=self.member_b.pk).update(all_matching_pairs=3)
+
+        self.assertEqual(recompute_ranks(), 2)
+        self.assertEqual(recompute_ranks(), 0)
+        self.member_a.refresh_from_db()
+        self.member_b.refresh_from_db()
+        self.assertEqual((self.member_a.rank_no, self.member_b.rank_no), (2, 1))
+        rewards = IncomeHistory.objects.filter(income_type=IncomeHistory.INCOME_REWARD)
+        self.assertEqual(sorted(rewards.values_list('amount', flat=True)),
+                         [Decimal('100.00'), Decimal('100.00'), Decimal('500.00')])
+        self.assertEqual(self.member_a.wallet_balance, Decimal('600.00'))
+
+    def test_rank_recompute_commits_per_chunk(self):
+        RankAndRewards.objects.create(rank_no=1, rank_name='Star', pairs=2, amount=Decimal('100.00'))
+        RankAndRewards.objects.create(rank_no=2, rank_name='Gold', pairs=5, amount=Decimal('500.00'))
+        Member.objects.filter(pk=self.member_a.pk).update(all_matching_pairs=2)
+        Member.objects.filter(pk=self.member_b.pk).update(all_matching_pairs=6)
+        wallet = CompanyWallet.objects.get(pk=1)
+        wallet.deduct_from_wallet(wallet.get_balance() - Decimal('100.00'))
+
+        with self.assertRaises(ValueError):
+            recompute_ranks(chunk_size=1)
+        self.member_a.refresh_from_db()
+        self.member_b.refresh_from_db()
+        self.assertEqual((self.member_a.rank_no, self.member_b.rank_no), (1, 0))
+        self.assertEqual(self.member_a.wallet_balance, Decimal('100.00'))
+        self.assertEqual(self.member_b.wallet_balance, Decimal('0.00'))
+
+    def test_level_cache_invalidated_on_save(self):
+        level = Level.objects.create(plan=self.plan, level=1, distributed_amount=Decimal('20.00'))
+        self.assertEqual(Level.for_plan(self.plan.pk)[1][0], Decimal('20.00'))
+        with self.assertNumQueries(0):
+            Level.for_plan(self.plan.pk)
+        level.distributed_amount = Decimal('25.00')
+        level.save()
+        self.assertEqual(Level.for_plan(self.plan.pk)[1][0], Decimal('25.00'))
+
+        # writes made by another process (no local invalidation) are picked up once the TTL lapses
+        with override_settings(MLM_LEVEL_CACHE_TTL=0):
+            level.save()
+            Level.for_plan(self.plan.pk)
+            Level.objects.filter(pk=level.pk).update(distributed_amount=Decimal('30.00'))
+            self.assertEqual(Level.for_plan(self.plan.pk)[1][0], Decimal('30.00'))
+
+
+class PlacementTreeTests(TestCase):
+    def _member(self, username):
+        user = User.objects.create_user(username=username, password='pass')
+        return Member.objects.create(user=user)
+
+    def setUp(self):
+        self.root = self._member('root')
+
+    def test_closure_backed_teams(self):
+        left = self._member('left')
+        right = self._member('right')
+        left_left = self._member('left_left')
+        self.root.assign_new_member(left, position=Member.Position.LEFT)
+        self.root.assign_new_member(right, position=Member.Position.RIGHT)
+        left.assign_new_member(left_left, position=Member.Position.LEFT)
+
+        self.assertEqual(self.root.get_left_team(), [left, left_left])
+        self.assertEqual(self.root.get_right_team(), [right])
+        self.assertEqual(list(self.root.get_downline(max_depth=1)), [left, right])
+        self.assertEqual(MemberClosure.objects.filter(descendant=left_left).count(), 3)
+
+        with self.assertNumQueries(1):
+            self.root.get_left_team()
+
+    def test_placement_below_unindexed_tree_reaches_every_ancestor(self):
+        a, b, c = self._member('a'), self._member('b'), self._member('c')
+        self.root.assign_new_member(a, position=Member.Position.LEFT)
+        a.assign_new_member(b, position=Member.Position.RIGHT)
+        MemberClosure.objects.all().delete()  # tree placed before the index and paths existed
+        Member.objects.update(path='', depth=0)
+
+        Member.objects.get(pk=b.pk).assign_new_member(c, position=Member.Position.LEFT)
+        self.root.refresh_from_db()
+        a.refresh_from_db()
+        self.assertEqual((self.root.left_count, a.right_count), (3, 2))
+        self.assertEqual(set(MemberClosure.objects.filter(descendant=c).values_list('ancestor_id', 'depth', 'leg')),
+                         {(c.pk, 0, None), (b.pk, 1, 'LEFT'), (a.pk, 2, 'RIGHT'), (self.root.pk, 3, 'LEFT')})
+        self.assertEqual(Member.objects.get(pk=c.pk).path, f'{self.root.pk}/{a.pk}/{b.pk}/{c.pk}/')
+
+    def test_rebuild_tree_index_matches_incremental_rows(self):
+        for name, position in [('a1', 'LEFT'), ('a2', 'RIGHT'), ('a3', 'LEFT')]:
+            self.root.assign_new_member(self._member(name), position=position)
+        expected = set(MemberClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth', 'leg'))
+
+        call_command('rebuild_tree_index', stdout=StringIO())
+        self.assertEqual(set(MemberClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth', 'leg')), expected)
+
+    def test_rebuild_tree_counters_repairs_drift(self):
+        left, right, left_left = self._member('left'), self._member('right'), self._member('left_left')
+        self.root.assign_new_member(left, position=Member.Position.LEFT)
+        self.root.assign_new_member(right, position=Member.Position.RIGHT)
+        left.assign_new_member(left_left, position=Member.Position.LEFT)
+        left_left.activate()
+        expected = set(Member.objects.values_list('pk', 'left_count', 'right_count', 'left_active_count', 'right_active_count'))
+
+        Member.objects.filter(pk=self.root.pk).update(left_count=9, right_active_count=4)
+        out = StringIO()
+        call_command('rebuild_tree_counters', batch_size=1, stdout=out)
+        self.assertIn('Counters corrected for 1 of 4 member(s).', out.getvalue())
+        self.assertEqual(
+            set(Member.objects.values_list('pk', 'left_count', 'right_count', 'left_active_count', 'right_active_count')),
+            expected,
+        )
+
+    def test_generated_tree_and_benchmark(self):
+        call_command('generate_mlm_tree', members=20, shape='skewed', seed=1, stdout=StringIO())
+        generated_root = Member.objects.get(user__username='bench0')
+        self.assertEqual((generated_root.left_count, generated_root.right_count), (15, 4))
+        self.assertEqual(MemberPlan.objects.filter(status=MemberPlan.STATUS_COMPLETED).count(), 12)
+
+        out = StringIO()
+        call_command('benchmark_mlm', iterations=2, seed=1, stdout=out)
+        for path in ('find_placement', 'assign_new_member', 'process_commissions_for_purchase', 'update_matching_income'):
+            self.assertIn(path, out.getvalue())
+        self.assertEqual(Member.objects.count(), 21)  # benchmark writes are rolled back
+
+    def test_bulk_import_matches_rebuilt_index(self):
+        left = self._member('left')
+        self.root.assign_new_member(left, position=Member.Position.LEFT)
+        csv_rows = [
+            'username,email,sponsor,position',
+            'x,x@example.com,root,',
+            'y,,x,LEFT',
+            'z,,root,LEFT',
+            'w,,y,',
+            'solo,,,',
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            handle.write('\n'.join(csv_rows))
+        self.addCleanup(os.remove, handle.name)
+
+        out = StringIO()
+        call_command('import_members', handle.name, dry_run=True, stdout=out)
+        self.assertIn('x: sponsor root, placed RIGHT of root', out.getvalue())
+        self.assertIn('z: sponsor root, placed LEFT of left', out.getvalue())
+        self.assertEqual(Member.objects.count(), 2)
+
+        call_command('import_members', handle.name, stdout=StringIO())
+        self.assertEqual(Member.objects.get(user__username='w').head_member.user.username, 'y')
+        self.assertIsNone(Member.objects.get(user__username='solo').head_member)
+        self.root.refresh_from_db()
+        self.assertEqual((self.root.left_count, self.root.right_count), (2, 3))
+
+        def snapshot():  # the rebuilds also index unplaced profiles such as "solo" as roots
+            placed = Member.objects.exclude(user__username='solo')
+            return (set(MemberClosure.objects.filter(descendant__in=placed)
+                        .values_list('ancestor_id', 'descendant_id', 'depth', 'leg')),
+                    set(placed.values_list('pk', 'left_tail_id', 'right_tail_id', 'path', 'depth')),
+                    set(SponsorClosure.objects.filter(descendant__in=placed).values_list('ancestor_id', 'descendant_id', 'depth')))
+        imported = snapshot()
+        call_command('rebuild_tree_index', stdout=StringIO())
+        call_command('rebuild_tree_paths', stdout=StringIO())
+        call_command('rebuild_sponsor_index', stdout=StringIO())
+        self.assertEqual(snapshot(), imported)
+        out = StringIO()
+        call_command('rebuild_tree_counters', dry_run=True, stdout=out)
+        self.assertIn('0 member(s) have drifted counters.', out.getvalue())
+
+    def test_relocate_subtree_matches_rebuilt_index(self):
+        a, b, c, d, e = (self._member(name) for name in 'abcde')
+        self.root.assign_new_member(a, position=Member.Position.LEFT)
+        self.root.assign_new_member(b, position=Member.Position.RIGHT)
+        a.assign_new_member(c, position=Member.Position.LEFT)
+        a.assign_new_member(d, position=Member.Position.RIGHT)
+        c.assign_new_member(e, position=Member.Position.LEFT)
+        d.activate()
+        e.activate()
+        with self.assertRaises(ValidationError):
+            relocate_subtree(a, e, Member.Position.LEFT)
+
+        relocate_subtree(c, b, Member.Position.RIGHT)
+        self.root.refresh_from_db()
+        self.assertEqual((self.root.left_count, self.root.right_count), (2, 3))
+        self.assertEqual((self.root.left_active_count, self.root.right_active_count), (1, 1))
+        self.assertEqual((self.root.left_tail_id, self.root.right_tail_id), (a.pk, c.pk))
+        self.assertEqual(Member.objects.get(pk=e.pk).path, f'{self.root.pk}/{b.pk}/{c.pk}/{e.pk}/')
+
+        def snapshot():
+            return (set(MemberClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth', 'leg')),
+                    set(Member.objects.values_list('pk', 'left_tail_id', 'right_tail_id', 'path', 'depth')))
+        relocated = snapshot()
+        call_command('rebuild_tree_index', stdout=StringIO())
+        call_command('rebuild_tree_paths', stdout=StringIO())
+        self.assertEqual(snapshot(), relocated)
+        out = StringIO()
+        call_command('rebuild_tree_counters', dry_run=True, stdout=out)
+        self.assertIn('0 member(s) have drifted counters.', out.getvalue())
+
+    def test_relocate_subtree_under_unindexed_head(self):
+        a, b, c, e, x = (self._member(name) for name in 'abcex')
+        self.root.assign_new_member(a, position=Member.Position.LEFT)
+        self.root.assign_new_member(b, position=Member.Position.RIGHT)
+        a.assign_new_member(c, position=Member.Position.LEFT)
+        c.assign_new_member(e, position=Member.Position.LEFT)
+        b.assign_new_member(x, position=Member.Position.LEFT)
+        MemberClosure.objects.filter(descendant=x).delete()  # x placed before the index existed
+
+        relocate_subtree(c, Member.objects.get(pk=x.pk), Member.Position.LEFT)
+        counts = dict((pk, (left, right)) for pk, left, right in Member.objects.values_list('pk', 'left_count', 'right_count'))
+        self.assertEqual((counts[self.root.pk], counts[b.pk], counts[x.pk]), ((1, 4), (3, 0), (2, 0)))
+        relocated = set(MemberClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth', 'leg'))
+        call_command('rebuild_tree_index', stdout=StringIO())
+        self.assertEqual(set(MemberClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth', 'leg')), relocated)
+
+    def test_relocate_subtree_without_index(self):
+        a, b, c, e = (self._member(name) for name in 'abce')
+        self.root.assign_new_member(a, position=Member.Position.LEFT)
+        self.root.assign_new_member(b, position=Member.Position.RIGHT)
+        a.assign_new_member(c, position=Member.Position.LEFT)
+        c.assign_new_member(e, position=Member.Position.LEFT)
+        MemberClosure.objects.all().delete()
+
+        # a leaf moves from its chain alone; a subtree needs its rows
+        relocate_subtree(Member.objects.get(pk=e.pk), b, Member.Position.RIGHT)
+        self.root.refresh_from_db()
+        self.assertEqual((self.root.left_count, self.root.right_count), (2, 2))
+        with self.assertRaisesMessage(ValidationError, 'rebuild_tree_index'):
+            relocate_subtree(Member.objects.get(pk=a.pk), Member.objects.get(pk=e.pk), Member.Position.LEFT)
+
+    def test_relocate_subtree_with_legacy_null_tails(self):
+        a, b, c, d, x = (self._member(name) for name in 'abcdx')
+        self.root.assign_new_member(a, position=Member.Position.LEFT)
+        self.root.assign_new_member(b, position=Member.Position.RIGHT)
+        a.assign_new_member(c, position=Member.Position.LEFT)
+        a.assign_new_member(d, position=Member.Position.RIGHT)
+        Member.objects.update(left_tail=None, right_tail=None)  # rows placed before the tail pointers existed
+
+        relocate_subtree(Member.objects.get(pk=c.pk), d, Member.Position.LEFT)
+        self.assertEqual(set(Member.objects.filter(pk__in=[b.pk, x.pk]).values_list('left_tail', flat=True)), {None})
+        self.assertEqual(Member.objects.get(pk=self.root.pk).get_leg_tail(Member.Position.LEFT), a)
+        self.assertEqual(Member.objects.get(pk=b.pk).find_placement(Member.Position.LEFT)[0], b)
+        self.assertEqual(Member.objects.get(pk=d.pk).get_leg_tail(Member.Position.LEFT), c)
+
+    def test_materialized_paths(self):
+        left, right, left_left = self._member('left'), self._member('right'), self._member('left_left')
+        self.root.assign_new_member(left, position=Member.Position.LEFT)
+        self.root.assign_new_member(right, position=Member.Position.RIGHT)
+        left.assign_new_member(left_left, position=Member.Position.LEFT)
+
+        left_left = Member.objects.get(pk=left_left.pk)
+        self.assertEqual((left_left.path, left_left.depth), (f'{self.root.pk}/{left.pk}/{left_left.pk}/', 2))
+        with self.assertNumQueries(0):
+            self.assertEqual(left_left.get_upline_ids(), [left.pk, self.root.pk])
+        root = Member.objects.get(pk=self.root.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(left_left.is_in_downline_of(root))
+            self.assertFalse(root.is_in_downline_of(left_left))
+
+        # a moved subtree is re-rooted in one statement
+        Member.objects.get(pk=left.pk).rewrite_subtree_paths(Member.objects.get(pk=right.pk).path)
+        self.assertEqual(Member.objects.get(pk=left_left.pk).path, f'{self.root.pk}/{right.pk}/{left.pk}/{left_left.pk}/')
+        self.assertEqual(Member.objects.get(pk=left_left.pk).depth, 3)
+
+        Member.objects.update(path='', depth=0)
+        call_command('rebuild_tree_paths', stdout=StringIO())
+        self.assertEqual(Member.objects.get(pk=left_left.pk).path, f'{self.root.pk}/{left.pk}/{left_left.pk}/')
+
+    def test_placement_uses_leg_tail_pointers(self):
+        chain = [self._member(f'l{i}') for i in range(5)]
+        for member in chain:
+            self.root.assign_new_member(member, position=Member.Position.LEFT)
+        self.root.refresh_from_db()
+        self.assertEqual(self.root.left_tail_id, chain[-1].pk)
+        self.assertEqual(Member.objects.get(pk=chain[1].pk).left_tail_id, chain[-1].pk)
+
+        # placement cost no longer depends on how deep the outer leg is
+        with self.assertNumQueries(1):
+            head, position = self.root.find_placement(Member.Position.LEFT)
+        self.assertEqual((head, position), (chain[-1], Member.Position.LEFT))
+
+        # legacy rows without pointers are repaired by walking once
+        Member.objects.update(left_tail=None, right_tail=None)
+        self.root.refresh_from_db()
+        self.assertEqual(self.root.find_placement(Member.Position.LEFT)[0], chain[-1])
+        call_command('rebuild_tree_index', stdout=StringIO())
+        self.assertEqual(Member.objects.get(pk=chain[2].pk).left_tail_id, chain[-1].pk)
+
+    def test_genealogy_endpoint_is_depth_windowed(self):
+        left, right, left_left = self._member('left'), self._member('right'), self._member('left_left')
+        self.root.assign_new_member(left, position=Member.Position.LEFT)
+        self.root.assign_new_member(right, position=Member.Position.RIGHT)
+        left.assign_new_member(left_left, position=Member.Position.LEFT)
+        client = APIClient()
+        client.force_authenticate(self.root.user)
+
+        response = client.get(reverse('member-genealogy'), {'depth': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([child['username'] for child in response.data['children']], ['left', 'right'])
+        self.assertTrue(response.data['children'][0]['has_children'])
+        self.assertEqual(response.data['children'][0]['children'], [])
+
+        # expand the frontier node
+        response = client.get(reverse('member-genealogy'), {'root': left.pk, 'depth': 1})
+        self.assertEqual(response.data['children'][0]['username'], 'left_left')
+
+        client.force_authenticate(right.user)
+        response = client.get(reverse('member-genealogy'), {'root': left.pk})
+        self.assertEqual(response.status_code, 403)
+
+    def test_referral_generations_endpoint(self):
+        cache.clear()
+        a, b, c = self._member('a'), self._member('b'), self._member('c')
+        self.root.assign_new_member(a)
+        self.root.assign_new_member(b)
+        a.assign_new_member(c)
+        client = APIClient()
+        client.force_authenticate(self.root.user)
+
+        with self.assertNumQueries(2):  # user lookup + one grouped query
+            response = client.get(reverse('member-referral-generations'))
+        self.assertEqual(response.data['generations'], [
+            {'generation': 1, 'members': 2, 'active': 0},
+            {'generation': 2, 'members': 1, 'active': 0},
+        ])
+
+        # served from cache until the next referral below the member
+        Member.objects.get(pk=c.pk).activate()
+        with self.assertNumQueries(1):
+            client.get(reverse('member-referral-generations'))
+        Member.objects.get(pk=c.pk).assign_new_member(self._member('d'))
+        response = client.get(reverse('member-referral-generations'))
+        self.assertEqual(response.data['generations'][1], {'generation': 2, 'members': 1, 'active': 1})
+        self.assertEqual(response.data['generations'][2], {'generation': 3, 'members': 1, 'active': 0})
+
+        rows = set(SponsorClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        call_command('rebuild_sponsor_index', stdout=StringIO())
+        self.assertEqual(set(SponsorClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), rows)
+
+    def test_counter_propagation_is_depth_independent(self):
+        def place_counting_queries(position):
+            member = self._member(f'n{Member.objects.count()}')
+            sponsor = Member.objects.get(pk=self.root.pk)
+            with CaptureQueriesContext(connection) as ctx:
+                sponsor.assign_new_member(member, position=position)
+            return len(ctx.captured_queries)
+
+        place_counting_queries(Member.Position.RIGHT)
+        shallow = place_counting_queries(Member.Position.LEFT)
+        for _ in range(6):
+            deep = place_counting_queries(Member.Position.LEFT)
+        self.assertEqual(shallow, deep)
+
+        self.root.refresh_from_db()
+        self.assertEqual(self.root.get_team_sizes(), (7, 1))
+        deepest = Member.objects.get(pk=self.root.left_tail_id)
+        self.assertEqual(deepest.head_member.get_team_sizes(), (1, 0))
+
+
+    def test_tree_arrays_match_maintained_counters(self):
+        members = [self.root]
+        for i in range(12):
+            member = self._member(f't{i}')
+            members[i // 3].assign_new_member(member)
+            members.append(member)
+        for member in members[::2]:
+            member.activate()
+
+        tree = TreeArrays.load()
+        left_count, right_count = tree.leg_sizes()
+        left_active, right_active = tree.active_leg_counts()
+        for member in Member.objects.all():
+            i = tree.index_of(member.pk)
+            self.assertEqual((left_count[i], right_count[i]), (member.left_count, member.right_count))
+            self.assertEqual((left_active[i], right_active[i]), (member.left_active_count, member.right_active_count))
+            self.assertEqual(tree.ancestors(member.pk), [m.pk for m in member.get_uplines()])
+
+        deepest = members[-1]
+        self.assertTrue(tree.is_in_downline(deepest.pk, self.root.pk))
+        self.assertFalse(tree.is_in_downline(self.root.pk, deepest.pk))
+        self.assertEqual(int(tree.depth_distribution().sum()), len(members))
+        self.assertEqual(int(tree.kth_ancestor(2, [tree.index_of(deepest.pk)])[0]),
+                         tree.index_of(deepest.get_uplines()[1].pk))
+
+class CompanyWalletTests(TestCase):
+    def test_global_pool_is_distributed_set_based(self):
+        CompanyWallet.objects.create(balance=Decimal('1000.00'))
+        members = []
+        for i, income in enumerate(['30.00', '20.00', '10.00']):
+            member = Member.objects.create(user=User.objects.create_user(username=f'p{i}', password='pass'),
+                                           status=Member.Status.ACTIVE, total_income=Decimal(income))
+            members.append(member)
+
+        result = distribute_global_pool(pool_size=2)
+        self.assertEqual(result, {"distributed": 20.0, "shares": 10.0, "members": 2})
+        self.assertEqual(CompanyWallet.objects.get(pk=1).get_balance(), Decimal('980.00'))
+        balances = [Member.objects.get(pk=m.pk).wallet_balance for m in members]
+        self.assertEqual(balances, [Decimal('10.00'), Decimal('10.00'), Decimal('0.00')])
+        self.assertEqual(IncomeHistory.objects.filter(income_type=IncomeHistory.INCOME_REWARD).count(), 2)
+
+    def test_sharded_balance_and_compaction(self):
+        wallet = CompanyWallet.objects.create(balance=Decimal('100.00'))
+        wallet.add_to_wallet('50.00')
+        wallet.deduct_from_wallet('30.00')
+        wallet.deduct_from_wallet('20.00')
+        self.assertEqual(wallet.get_balance(), Decimal('100.00'))
+        with self.assertRaises(ValueError):
+            wallet.deduct_from_wallet('100.01')
+        self.assertFalse(wallet.shards.filter(balance__lt=0).exists())
+
+        self.assertEqual(wallet.compact(), Decimal('100.00'))
+        self.assertEqual(wallet.balance, Decimal('0.00'))  # the reserve is spread over the shards
+        self.assertEqual(set(wallet.shards.values_list('balance', flat=True)), {Decimal('12.50')})
+        with self.assertNumQueries(1):  # covered by the home shard: one guarded UPDATE
+            wallet.deduct_from_wallet('10.00')
+        wallet.deduct_from_wallet('80.00')  # no single shard covers it: taken from the total
+        self.assertEqual(wallet.get_balance(), Decimal('10.00'))
+
+    def test_uncovered_payout_is_rolled_back(self):
+        CompanyWallet.objects.create(balance=Decimal('10.00'))
+        sponsor = Member.objects.create(user=User.objects.create_user(username='s', password='pass'))
+        buyer = Member.objects.create(user=User.objects.create_user(username='t', password='pass'))
+        sponsor.assign_new_member(buyer)
+        plan = Plan.objects.create(name='Starter', price=Decimal('499.00'), direct=Decimal('50.00'))
+        with self.assertRaises(ValueError):
+            process_commissions_for_plans([MemberPlan.objects.create(member=buyer, plan=plan)])
+        sponsor.refresh_from_db()
+        self.assertEqual(sponsor.direct_income, Decimal('0.00'))
+        self.assertEqual(CompanyWallet.objects.get(pk=1).get_balance(), Decimal('10.00'))
+
+
+class ConcurrentPlacementTests(TransactionTestCase):
+    def test_concurrent_registrations_keep_tree_consistent(self):
+        out = StringIO()
+        call_command('stress_placement', members=120, threads=6, sponsors=3, seed=1, stdout=out)
+        self.assertIn('tree consistent', out.getvalue())
+        call_command('stress_placement', members=60, threads=4, batch_size=5, prefix='batch', seed=2, stdout=out)
+        self.assertEqual(Member.objects.filter(head_member__isnull=False).count(), 180)
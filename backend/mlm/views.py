@@ -3,12 +3,13 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from .models import Member, Plan, MemberPlan, IncomeHistory, WalletTransaction, PaymentRequest
+from .models import Member, Plan, MemberPlan, CommissionJob, IncomeHistory, WalletTransaction, PaymentRequest
 from .serializers import (
-    MemberSerializer, PlanSerializer, MemberPlanSerializer,
+    MemberSerializer, PlanSerializer, MemberPlanSerializer, CommissionJobSerializer,
     IncomeHistorySerializer, WalletTransactionSerializer, PaymentRequestSerializer
 )
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from .services import get_genealogy, GENEALOGY_DEFAULT_DEPTH
 from django.db import transaction
 
 class PlanViewSet(viewsets.ReadOnlyModelViewSet):
@@ -18,16 +19,55 @@ class PlanViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class MemberViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Member.objects.select_related('user').all()
+    queryset = Member.objects.select_related('user', 'sponsor__user', 'head_member__user').all()
     serializer_class = MemberSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        # members see their own profile, staff can see all
+        if self.request.user.is_staff:
+            return self.queryset
+        return self.queryset.filter(user=self.request.user)
+
     @action(detail=False, methods=['get'])
     def me(self, request):
         member = get_object_or_404(Member, user=request.user)
         serializer = self.get_serializer(member)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def income_summary(self, request):
+        """Today, this month and per-type income totals of the own profile (served from daily rollups)."""
+        member = get_object_or_404(Member, user=request.user)
+        return Response(member.get_income_summary())
+
+    @action(detail=False, methods=['get'])
+    def referral_generations(self, request):
+        """Per-generation referral counts (members / active) of the own profile, or of ?member=<id> for staff."""
+        member = get_object_or_404(Member, user=request.user)
+        if request.query_params.get('member') and request.user.is_staff:
+            member = get_object_or_404(Member, pk=request.query_params['member'])
+        return Response({'member': member.pk, 'generations': member.get_referral_generations()})
+
+    @action(detail=False, methods=['get'])
+    def genealogy(self, request):
+        """
+        Binary tree below ?root=<member id> (default: own profile), ?depth=<levels>.
+        Expand a frontier node by calling again with root=<its id>.
+        """
+        me = get_object_or_404(Member, user=request.user)
+        root = me
+        if request.query_params.get('root'):
+            root = get_object_or_404(Member, pk=request.query_params['root'])
+            in_downline = root == me or root.is_in_downline_of(me)
+            if not (request.user.is_staff or in_downline):
+                return Response({"detail": "Member is not in your downline."}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            depth = int(request.query_params.get('depth', GENEALOGY_DEFAULT_DEPTH))
+        except ValueError:
+            return Response({"detail": "depth must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_genealogy(root, depth))
+
 
 class MemberPlanViewSet(viewsets.ModelViewSet):
     queryset = MemberPlan.objects.select_related('member', 'plan').all()
@@ -45,14 +85,27 @@ class MemberPlanViewSet(viewsets.ModelViewSet):
         member = get_object_or_404(Member, user=self.request.user)
         serializer.save(member=member)
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def mark_complete(self, request, pk=None):
+        """Staff only: confirm the payment of a plan, which completes it and pays its commissions."""
         plan_obj = self.get_object()
         try:
             plan_obj.mark_completed()
-            return Response({"detail": "Marked completed and processed."})
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        job = CommissionJob.objects.filter(member_plan=plan_obj).first()
+        if job is None or job.status == CommissionJob.STATUS_DONE:
+            return Response({"detail": "Marked completed and processed.",
+                             "commission": CommissionJobSerializer(job).data if job else None})
+        return Response({"detail": "Marked completed; commissions are being processed.",
+                         "commission": CommissionJobSerializer(job).data},
+                        status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'])
+    def commission_status(self, request, pk=None):
+        plan_obj = self.get_object()
+        job = get_object_or_404(CommissionJob, member_plan=plan_obj)
+        return Response(CommissionJobSerializer(job).data)
 
 
 class IncomeHistoryViewSet(viewsets.ReadOnlyModelViewSet):
@@ -4,6 +4,7 @@ from .models import CustomUser
 from backend.utils import generate_username
 from django.db import transaction
 from mlm.models import Member
+from mlm.services import place_member
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 
@@ -131,10 +132,10 @@ class UserRegistrationSerializer(serializers.Serializer):
         # (Even if client requested auto_placement incorrectly,
         # we enforce the above rule set based on presence of sponsor/position.)
         try:
-            head_member, final_position = sponsor_member.assign_new_member(
-                new_member=new_member,
+            head_member, final_position = place_member(
+                sponsor_member,
+                new_member,
                 position=position,           # may be None
-                auto_placement=auto_placement
             )
         except ValidationError as e:
             raise serializers.ValidationError({"placement": e.message})